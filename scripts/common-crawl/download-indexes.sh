@@ -16,7 +16,9 @@ for index_name in "$@"; do
     wget https://commoncrawl.s3.amazonaws.com/crawl-data/${index_name}/cc-index.paths.gz -O ${index_paths_file}
   fi
 
-  for file_path in $(zcat ${index_paths_file} | grep .gz); do
+  # The cluster.idx lists the first key of every compressed block in the
+  # index files so only the blocks which can contain a url need to be read
+  for file_path in $(zcat ${index_paths_file} | grep -e .gz -e cluster.idx); do
     filename=$(basename ${file_path})
     target_path="${index_dir}/${filename}"
     if [ ! -f ${target_path} ]; then
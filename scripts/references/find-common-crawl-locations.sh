@@ -1,7 +1,8 @@
 #!/bin/sh
 #$ -cwd
+#$ -pe parallel-onenode 32
 
-index_name=$1
-indx_file_path=$2
-
-python -m wikicite.references.find_common_crawl_locations ${index_name} ${indx_file_path}
+# Scan all of the index files for every crawl with one process so the urls
+# only need to be loaded once
+python -m wikicite.references.find_common_crawl_locations "$@" \
+  --num-processes 32
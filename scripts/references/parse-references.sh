@@ -5,4 +5,5 @@
 html_file_path=$1
 
 python -m wikicite.references.parse_references ${html_file_path} \
+  --num-workers 8 \
   --num-cores 8
@@ -1,19 +1,14 @@
 #!/bin/sh
 #$ -cwd
-#$ -pe parallel-onenode 1
-set -e
+#$ -pe parallel-onenode 4
 if [ "$#" -ne 0 ]; then
     echo "Usage: qsub scripts/references/scrape-all-common-crawl.sh"
     exit
 fi
 
-# Scrape the data in serial to not overwhelm the server
-for locations_file_path in $(find data/references/common-crawl-locations/*.bz2); do
-  python -m wikicite.references.scrape_common_crawl ${locations_file_path}
-  if [[ $? == 0 ]]; then
-    :
-  else
-    echo "Exiting early";
-    exit
-  fi
-done
+# Scrape several shards at once. They all share one QPS budget so that the
+# server isn't overwhelmed, and the progress of every shard is saved so the
+# script can be rerun to resume or retry failed shards.
+python -m wikicite.references.scrape_all_common_crawl \
+  --num-shards 4 \
+  --max-qps 10
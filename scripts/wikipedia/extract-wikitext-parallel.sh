@@ -0,0 +1,6 @@
+#!/bin/sh
+#$ -cwd
+#$ -pe parallel-onenode 64
+
+# Extracts every shard on one machine instead of submitting a job per shard
+python -m wikicite.wikipedia.extract_all_wikitext --num-processes 64
@@ -0,0 +1,49 @@
+// Serves requests from node_workers.py over stdin and stdout. Every request is
+// a 4-byte big-endian length followed by the UTF-8 payload, and every response
+// is a status byte (0 for success, 1 for an error message), the length and the
+// payload. The requests are handled one at a time in the order they arrive.
+'use strict';
+
+function writeResponse(status, text) {
+  const payload = Buffer.from(text, 'utf8');
+  const header = Buffer.alloc(5);
+  header.writeUInt8(status, 0);
+  header.writeUInt32BE(payload.length, 1);
+  process.stdout.write(Buffer.concat([header, payload]));
+}
+
+function serve(handler) {
+  let buffer = Buffer.alloc(0);
+  let queue = Promise.resolve();
+
+  process.stdin.on('data', function(chunk) {
+    buffer = Buffer.concat([buffer, chunk]);
+    while (buffer.length >= 4) {
+      const length = buffer.readUInt32BE(0);
+      if (buffer.length < 4 + length) {
+        break;
+      }
+      const input = buffer.toString('utf8', 4, 4 + length);
+      buffer = buffer.slice(4 + length);
+
+      queue = queue.then(function() {
+        return Promise.resolve().then(function() {
+          return handler(input);
+        }).then(function(output) {
+          writeResponse(0, output);
+        }, function(error) {
+          writeResponse(1, String(error && error.stack || error));
+        });
+      });
+    }
+  });
+
+  // The Python side closes stdin to stop the worker
+  process.stdin.on('end', function() {
+    queue.then(function() {
+      process.exit(0);
+    });
+  });
+}
+
+module.exports = { serve: serve };
@@ -0,0 +1,166 @@
+import logging
+import os
+import queue
+import select
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+from wikicite.pipeline import executor_map
+
+# Every request is a 4-byte big-endian length followed by the UTF-8 payload.
+# Every response is a status byte (0 for success, 1 for an error message), the
+# length and the payload. See node_worker.js for the other side.
+_request_struct = Struct('>I')
+_response_struct = Struct('>BI')
+
+
+class NodeWorker(object):
+    def __init__(self,
+                 script: str,
+                 timeout: float = 60,
+                 max_requests: int = None,
+                 max_memory_mb: float = None) -> None:
+        # A long-lived node process which handles one request at a time. The
+        # process is restarted if a request times out or the process crashes,
+        # and it is recycled after `max_requests` requests or once its resident
+        # memory is above `max_memory_mb`, since the JavaScript libraries
+        # tend to leak memory.
+        self.script = script
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.max_memory_mb = max_memory_mb
+        self.process = None
+        self.num_requests = 0
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(['node', self.script],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.num_requests = 0
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def kill(self) -> None:
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def _memory_mb(self) -> float:
+        try:
+            with open(f'/proc/{self.process.pid}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0
+
+    def _needs_recycling(self) -> bool:
+        if self.max_requests is not None and self.num_requests >= self.max_requests:
+            return True
+        if self.max_memory_mb is not None and self._memory_mb() > self.max_memory_mb:
+            return True
+        return False
+
+    def _read_exactly(self, num_bytes: int, deadline: float) -> bytes:
+        fd = self.process.stdout.fileno()
+        chunks = []
+        while num_bytes > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError()
+            chunk = os.read(fd, min(num_bytes, 1 << 20))
+            if not chunk:
+                raise EOFError()
+            chunks.append(chunk)
+            num_bytes -= len(chunk)
+        return b''.join(chunks)
+
+    def request(self, data: str) -> Optional[str]:
+        # Returns the worker's response or None if the request failed or
+        # timed out
+        if self.process is not None and self._needs_recycling():
+            self.stop()
+        if self.process is None:
+            self.start()
+
+        self.num_requests += 1
+        payload = data.encode()
+        deadline = time.monotonic() + self.timeout
+        try:
+            self.process.stdin.write(_request_struct.pack(len(payload)) + payload)
+            self.process.stdin.flush()
+            status, length = _response_struct.unpack(self._read_exactly(_response_struct.size, deadline))
+            response = self._read_exactly(length, deadline).decode()
+        except TimeoutError:
+            logging.warning(f'Request to {self.script} timed out after {self.timeout} seconds')
+            self.kill()
+            return None
+        except (EOFError, BrokenPipeError):
+            logging.warning(f'{self.script} exited unexpectedly, restarting it')
+            self.kill()
+            return None
+
+        if status != 0:
+            logging.warning(f'{self.script} failed: {response}')
+            return None
+        return response
+
+
+class NodeWorkerPool(object):
+    def __init__(self,
+                 script: str,
+                 num_workers: int,
+                 timeout: float = 60,
+                 max_requests: int = None,
+                 max_memory_mb: float = None) -> None:
+        # Sends requests to `num_workers` node workers at the same time. Each
+        # worker is used by one thread at a time, and the threads spend almost
+        # all of their time waiting on the node process.
+        self.num_workers = num_workers
+        self.workers = queue.Queue()
+        for _ in range(num_workers):
+            self.workers.put(NodeWorker(script, timeout, max_requests, max_memory_mb))
+        self.executor = ThreadPoolExecutor(num_workers)
+
+    def __enter__(self) -> 'NodeWorkerPool':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        while not self.workers.empty():
+            self.workers.get().stop()
+
+    def _request(self, data: str) -> Optional[str]:
+        worker = self.workers.get()
+        try:
+            return worker.request(data)
+        finally:
+            self.workers.put(worker)
+
+    def map(self, items: Iterable[Tuple[Any, str]], ordered: bool = True) -> Iterator[Tuple[Any, Optional[str]]]:
+        # Yields (key, response) for each (key, data) item. At most twice as
+        # many items as there are workers are in flight, so the input is read
+        # lazily. If `ordered` is False, the responses are yielded as soon as
+        # they finish so that a slow request does not hold up the others.
+        return executor_map(self.executor, self._request, items, self.num_workers * 2, ordered)
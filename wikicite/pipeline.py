@@ -0,0 +1,93 @@
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# Marks the end of a prefetched iterator
+_end = object()
+
+
+class _Error(object):
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def prefetch(items: Iterable[T], max_size: int) -> Iterator[T]:
+    # Iterates over `items` in a background thread and yields them from a
+    # queue which holds at most `max_size` items, so that the stage which
+    # produces the items keeps working while the consumer is busy without
+    # running arbitrarily far ahead of it. Exceptions are raised in the
+    # consumer's thread.
+    buffer = queue.Queue(max_size)
+    stopped = threading.Event()
+
+    def put(item: Any) -> bool:
+        # Returns False if the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Error(e))
+            return
+        put(_end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _end:
+                return
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+
+
+def executor_map(executor: Executor,
+                 func: Callable[..., Any],
+                 items: Iterable[Tuple[Any, Any]],
+                 max_in_flight: int,
+                 ordered: bool = True) -> Iterator[Tuple[Any, Any]]:
+    # Yields (key, func(value)) for each (key, value) item. At most
+    # `max_in_flight` items are submitted to the executor at once, so the
+    # input is read lazily. If `ordered` is False, the results are yielded as
+    # soon as they finish so that a slow item does not hold up the others.
+    in_flight = []
+    for key, value in items:
+        in_flight.append((key, executor.submit(func, value)))
+        if len(in_flight) >= max_in_flight:
+            in_flight = yield from _yield_finished(in_flight, ordered)
+    while in_flight:
+        in_flight = yield from _yield_finished(in_flight, ordered)
+
+
+def _yield_finished(in_flight: List[Tuple[Any, Future]], ordered: bool) -> Iterator[Tuple[Any, Any]]:
+    # Yields at least one finished result and returns the items which are
+    # still in flight
+    if ordered:
+        key, future = in_flight[0]
+        yield key, future.result()
+        return in_flight[1:]
+
+    done, _ = wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+    remaining = []
+    for key, future in in_flight:
+        if future in done:
+            yield key, future.result()
+        else:
+            remaining.append((key, future))
+    return remaining
@@ -0,0 +1,21 @@
+import argparse
+import logging
+import sys
+
+from wikicite.references.indexed_bz2_file import compile_index
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+
+def main(args):
+    logging.info(f'Compiling {args.index_file_glob} into {args.compiled_index_path}')
+    num_keys = compile_index(args.index_file_glob, args.compiled_index_path)
+    logging.info(f'Wrote {num_keys} keys')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('index_file_glob', help='e.g. "data/references/documents/documents-*-index.jsonl.bz2"')
+    argp.add_argument('compiled_index_path')
+    args = argp.parse_args()
+    main(args)
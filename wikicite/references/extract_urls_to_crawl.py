@@ -4,6 +4,7 @@ import json
 import logging
 import os
 import lxml.html
+import numpy as np
 import requests
 import sys
 import urllib.parse
@@ -12,6 +13,8 @@ from collections import Counter
 from io import StringIO
 from typing import Dict, List, Set, Tuple
 
+from wikicite.wikipedia.columnar import ColumnarArticles
+
 timeout = 60
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
@@ -67,6 +70,37 @@ def is_scrapable(url: str) -> bool:
         return False
 
 
+def load_urls_to_scrape(article_file: str, living_people: Set[int]) -> Set[str]:
+    urls_to_scrape = set()
+    with bz2.open(article_file, 'rb') as f:
+        for line in f:
+            article = json.loads(line.decode())
+            title = article['title']
+            page_id = article['page_id']
+            if page_id in living_people:
+                for reference in article['references'].values():
+                    url = get_url_to_scrape(reference)
+                    if url and is_scrapable(url):
+                        urls_to_scrape.add(url)
+    return urls_to_scrape
+
+
+def load_columnar_urls_to_scrape(article_file: str, living_people: Set[int]) -> Set[str]:
+    # Only reads the page ids, the reference offsets and the reference urls
+    urls_to_scrape = set()
+    with ColumnarArticles(article_file) as articles:
+        is_living = np.isin(articles['article_page_id'], list(living_people))
+        reference_is_living = is_living[articles.parents('article_reference_offsets')]
+        reference_urls = articles.strings('reference_url')
+        for index in np.flatnonzero(reference_is_living):
+            # An empty string is a missing url
+            reference = {'url': reference_urls[index]} if reference_urls[index] else {}
+            url = get_url_to_scrape(reference)
+            if url and is_scrapable(url):
+                urls_to_scrape.add(url)
+    return urls_to_scrape
+
+
 def main(args):
     shard_id = args.shard_id
 
@@ -79,18 +113,12 @@ def main(args):
     living_people = load_living_people(category_file)
 
     # Load all of the references which need to be scraped
-    article_file = f'data/wikipedia/articles/articles-{shard_id}.jsonl.bz2'
-    urls_to_scrape = set()
-    with bz2.open(article_file, 'rb') as f:
-        for line in f:
-            article = json.loads(line.decode())
-            title = article['title']
-            page_id = article['page_id']
-            if page_id in living_people:
-                for reference in article['references'].values():
-                    url = get_url_to_scrape(reference)
-                    if url and is_scrapable(url):
-                        urls_to_scrape.add(url)
+    if args.format == 'columnar':
+        article_file = f'data/wikipedia/articles/articles-{shard_id}.npz'
+        urls_to_scrape = load_columnar_urls_to_scrape(article_file, living_people)
+    else:
+        article_file = f'data/wikipedia/articles/articles-{shard_id}.jsonl.bz2'
+        urls_to_scrape = load_urls_to_scrape(article_file, living_people)
 
     with bz2.open(output_file, 'w') as out:
         for url in urls_to_scrape:
@@ -101,5 +129,7 @@ def main(args):
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('shard_id', type=int)
+    argp.add_argument('--format', choices=['jsonl', 'columnar'], default='jsonl',
+                      help='The format the articles were parsed into')
     args = argp.parse_args()
     main(args)
@@ -1,12 +1,45 @@
 import argparse
+import bisect
 import bz2
 import gzip
 import json
+import logging
+import math
+import mmap
+import multiprocessing
 import os
+import struct
+import sys
+import zlib
+from collections import defaultdict
 from glob import glob
 from pywb.utils.canonicalize import UrlCanonicalizeException, canonicalize
 from tqdm import tqdm
-from typing import Dict, List, Set, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(module)s: %(message)s',)
+
+# The canonical urls are saved as
+#   header | offsets of each url (count + 1 of them) | sorted url bytes | json sources
+# which can be memory-mapped and shared by every process that needs it. The
+# sources are the path, size and modification time of every url file the
+# canonical urls were loaded from, which is used to tell if they are stale.
+_urls_magic = b'WCURL002'
+_urls_header_struct = struct.Struct('<8sQQ')
+_offset_struct = struct.Struct('<Q')
+
+# The Bloom filter is saved as
+#   header (magic, number of bits, number of hashes) | bit array
+_bloom_magic = b'WCBLM002'
+_bloom_crc_seed = 0x5bd1e995
+_bloom_header_struct = struct.Struct('<8sQQ')
+
+# The canonical urls (or in the low memory mode, the memory-mapped url file
+# and its Bloom filter) are loaded once by the main process and then inherited
+# by the worker processes
+_urls = None
+_bloom_filter = None
 
 
 def get_shard_id(index_file_path: str) -> str:
@@ -30,6 +63,14 @@ def parse_index_entry(line: str) -> Dict[str, str]:
     }
 
 
+def get_url_sources(input_dir: str) -> List[List[Any]]:
+    sources = []
+    for file_path in sorted(glob(f'{input_dir}/*.bz2')):
+        stat = os.stat(file_path)
+        sources.append([file_path, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
 def load_urls(input_dir: str) -> Set[str]:
     urls = set()
     for file_path in tqdm(glob(f'{input_dir}/*.bz2')):
@@ -45,44 +86,299 @@ def load_urls(input_dir: str) -> Set[str]:
     return urls
 
 
-def main(args):
-    shard_id = get_shard_id(args.index_file_path)
+def save_canonical_urls(urls: Set[str], output_file: str, sources: List[List[Any]]) -> None:
+    encoded = sorted(url.encode() for url in urls)
+    temp_file = output_file + '.tmp'
+    with open(temp_file, 'wb') as out:
+        num_url_bytes = sum(len(url) for url in encoded)
+        sources_offset = _urls_header_struct.size + (len(encoded) + 1) * _offset_struct.size + num_url_bytes
+        out.write(_urls_header_struct.pack(_urls_magic, len(encoded), sources_offset))
+        offset = 0
+        for url in encoded:
+            out.write(_offset_struct.pack(offset))
+            offset += len(url)
+        out.write(_offset_struct.pack(offset))
+        for url in encoded:
+            out.write(url)
+        out.write(json.dumps(sources).encode())
+    os.replace(temp_file, output_file)
+
+
+def is_canonical_urls_file_current(urls_file: str, sources: List[List[Any]]) -> bool:
+    # The canonical urls are stale if a url file was added, removed or
+    # changed since they were saved
+    if not os.path.exists(urls_file):
+        return False
+    with open(urls_file, 'rb') as f:
+        header = f.read(_urls_header_struct.size)
+        if len(header) < _urls_header_struct.size:
+            return False
+        magic, _, sources_offset = _urls_header_struct.unpack(header)
+        if magic != _urls_magic:
+            return False
+        f.seek(sources_offset)
+        return json.loads(f.read().decode()) == sources
+
+
+class CanonicalUrls(object):
+    def __init__(self, file_path: str) -> None:
+        self.file = open(file_path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_urls, _ = _urls_header_struct.unpack_from(self.data, 0)
+        if magic != _urls_magic:
+            raise Exception(f'{file_path} is not a canonical urls file')
+        self.offsets_start = _urls_header_struct.size
+        self.urls_start = self.offsets_start + (self.num_urls + 1) * _offset_struct.size
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+    def __len__(self) -> int:
+        return self.num_urls
+
+    def __getitem__(self, index: int) -> bytes:
+        start, end = struct.unpack_from('<QQ', self.data, self.offsets_start + index * _offset_struct.size)
+        return self.data[self.urls_start + start:self.urls_start + end]
+
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(self.num_urls):
+            yield self[i]
+
+    def __contains__(self, url: bytes) -> bool:
+        lo, hi = 0, self.num_urls
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_url = self[mid]
+            if mid_url == url:
+                return True
+            if mid_url < url:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+
+class BloomFilter(object):
+    def __init__(self, bits, num_bits: int, num_hashes: int) -> None:
+        self.bits = bits
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+
+    @classmethod
+    def create(cls, num_items: int, error_rate: float) -> 'BloomFilter':
+        num_items = max(num_items, 1)
+        num_bits = max(int(math.ceil(-num_items * math.log(error_rate) / (math.log(2) ** 2))), 8)
+        num_hashes = max(int(round(num_bits / num_items * math.log(2))), 1)
+        return cls(bytearray((num_bits + 7) // 8), num_bits, num_hashes)
+
+    def _hashes(self, key: bytes) -> Tuple[int, int]:
+        # Double hashing derives all of the bit positions from two CRC32s
+        high = zlib.crc32(key)
+        low = zlib.crc32(key, _bloom_crc_seed)
+        return (high << 32) | low, (low << 32) | high | 1
+
+    def add(self, key: bytes) -> None:
+        h1, h2 = self._hashes(key)
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % self.num_bits
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        h1, h2 = self._hashes(key)
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % self.num_bits
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
 
-    output_dir = f'data/references/common-crawl-locations/{args.index_name}'
-    output_file = f'{output_dir}/locations-{shard_id}.jsonl.bz2'
-    os.makedirs(output_dir, exist_ok=True)
+    def save(self, output_file: str) -> None:
+        temp_file = output_file + '.tmp'
+        with open(temp_file, 'wb') as out:
+            out.write(_bloom_header_struct.pack(_bloom_magic, self.num_bits, self.num_hashes))
+            out.write(self.bits)
+        os.replace(temp_file, output_file)
+
+    @staticmethod
+    def is_current(file_path: str, urls_file: str) -> bool:
+        # The filter is stale if it was built with an older hash or before the
+        # canonical urls were last saved
+        if not os.path.exists(file_path) or os.path.getmtime(file_path) < os.path.getmtime(urls_file):
+            return False
+        with open(file_path, 'rb') as f:
+            return f.read(len(_bloom_magic)) == _bloom_magic
+
+    @classmethod
+    def load(cls, file_path: str) -> 'BloomFilter':
+        # The bits are memory-mapped so the forked workers share the same pages
+        with open(file_path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_bits, num_hashes = _bloom_header_struct.unpack_from(data, 0)
+        if magic != _bloom_magic:
+            raise Exception(f'{file_path} is not a Bloom filter file')
+        bits = memoryview(data)[_bloom_header_struct.size:]
+        return cls(bits, num_bits, num_hashes)
+
+
+def build_bloom_filter(urls: CanonicalUrls, error_rate: float) -> BloomFilter:
+    bloom_filter = BloomFilter.create(len(urls), error_rate)
+    for url in urls:
+        bloom_filter.add(url)
+    return bloom_filter
+
+
+def load_cluster_index(cluster_index_path: str) -> Tuple[List[bytes], List[Tuple[str, int, int]]]:
+    # Each line of the cluster.idx is "<surt> <timestamp>\t<cdx file>\t<offset>\t<length>\t<id>"
+    # and describes one gzip member of the CDX files, which contains a block
+    # of consecutive CDX lines that starts with that SURT key.
+    keys = []
+    blocks = []
+    with open(cluster_index_path, 'rb') as f:
+        for line in f:
+            columns = line.rstrip(b'\n').split(b'\t')
+            keys.append(columns[0][:columns[0].index(b' ')])
+            blocks.append((columns[1].decode(), int(columns[2]), int(columns[3])))
+    return keys, blocks
+
+
+def find_candidate_blocks(urls: Iterable[bytes], keys: List[bytes]) -> Set[int]:
+    # A url can only be in block i if keys[i] <= url <= keys[i + 1] because
+    # the CDX files are sorted by SURT key
+    candidates = set()
+    for url in urls:
+        first = max(bisect.bisect_left(keys, url) - 1, 0)
+        last = bisect.bisect_right(keys, url) - 1
+        candidates.update(range(first, last + 1))
+    return candidates
+
+
+def _iter_index_lines(index_file_path: str, blocks: List[Tuple[int, int]] = None) -> Iterator[bytes]:
+    if blocks is None:
+        with gzip.open(index_file_path, 'rb') as f:
+            yield from f
+        return
+
+    # Only decompress the blocks which could contain one of the urls
+    with open(index_file_path, 'rb') as f:
+        for offset, length in blocks:
+            f.seek(offset, 0)
+            data = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+            yield from data.splitlines(keepends=True)
+
+
+def scan_index_file(index_file_path: str, output_file: str, blocks: List[Tuple[int, int]] = None) -> Tuple[str, int]:
+    # The urls are compared as bytes so that the lines which do not match,
+    # which is almost all of them, are never decoded
+    found = set()
+    temp_file = output_file + '.tmp'
+    with bz2.open(temp_file, 'w') as out:
+        for line in _iter_index_lines(index_file_path, blocks):
+            first_space = line.index(b' ')
+            canonical_url = line[:first_space]
+
+            # In the low memory mode, almost every line is a miss, which the
+            # Bloom filter rejects without binary searching the url file
+            if _bloom_filter is not None and canonical_url not in _bloom_filter:
+                continue
+
+            # We only want to process each url once. There might be
+            # multiple entries for the same canonical url
+            if canonical_url not in found and canonical_url in _urls:
+                entry = parse_index_entry(line.decode().strip())
+                if entry['status'] != 200:
+                    continue
+
+                output_data = {
+                    'canonical_url': canonical_url.decode(),
+                    'filename': entry['filename'],
+                    'length': entry['length'],
+                    'offset': entry['offset']
+                }
+                out.write(json.dumps(output_data).encode() + b'\n')
+                found.add(canonical_url)
+
+    # The output is only moved into place once it is complete so that the
+    # scan can be restarted by skipping the finished files
+    os.replace(temp_file, output_file)
+    return index_file_path, len(found)
+
+
+def _scan_index_file(job: Tuple[str, str, List[Tuple[int, int]]]) -> Tuple[str, int]:
+    return scan_index_file(*job)
+
+
+def main(args):
+    global _urls, _bloom_filter
 
-    input_dir = f'data/references/urls'
-    urls = load_urls(input_dir)
+    # Canonicalizing the urls is expensive, so it is only done again when the
+    # url files change
+    url_dir = 'data/references/urls'
+    url_sources = get_url_sources(url_dir)
+    if not is_canonical_urls_file_current(args.urls_file, url_sources):
+        logging.info(f'Canonicalizing urls and saving them to {args.urls_file}')
+        save_canonical_urls(load_urls(url_dir), args.urls_file, url_sources)
+    canonical_urls = CanonicalUrls(args.urls_file)
+    if args.low_memory:
+        # The exact membership checks binary search the memory-mapped urls
+        # instead of building a set, so only the filter's bits are in memory.
+        # Checking the filter costs more CPU per line than a set lookup.
+        bloom_file = f'{args.urls_file}.bloom'
+        if not BloomFilter.is_current(bloom_file, args.urls_file):
+            logging.info(f'Building the Bloom filter and saving it to {bloom_file}')
+            build_bloom_filter(canonical_urls, args.bloom_error_rate).save(bloom_file)
+        _bloom_filter = BloomFilter.load(bloom_file)
+        _urls = canonical_urls
+    else:
+        _urls = set(canonical_urls)
+    logging.info(f'Loaded {len(canonical_urls)} canonical urls')
 
-    with bz2.open(output_file, 'w') as out:
-        with gzip.open(args.index_file_path, 'rb') as f:
-            for line in tqdm(f):
-                line = line.decode().strip()
-                first_space = line.index(' ')
-                canonical_url = line[:first_space]
+    jobs = []
+    for index_name in args.index_names:
+        index_dir = f'data/common-crawl/collections/{index_name}'
+        output_dir = f'data/references/common-crawl-locations/{index_name}'
+        os.makedirs(output_dir, exist_ok=True)
 
-                if canonical_url in urls:
-                    entry = parse_index_entry(line)
-                    if entry['status'] != 200:
-                        continue
+        # The blocks of each CDX file that need to be read, or None to read
+        # the whole file
+        file_to_blocks = defaultdict(lambda: None)
+        if args.use_cluster_index:
+            keys, blocks = load_cluster_index(f'{index_dir}/cluster.idx')
+            file_to_blocks = defaultdict(list)
+            for i in sorted(find_candidate_blocks(canonical_urls, keys)):
+                filename, offset, length = blocks[i]
+                file_to_blocks[filename].append((offset, length))
+            num_blocks = sum(len(file_blocks) for file_blocks in file_to_blocks.values())
+            logging.info(f'Reading {num_blocks} of {len(blocks)} blocks for {index_name}')
 
-                    output_data = {
-                        'canonical_url': canonical_url,
-                        'filename': entry['filename'],
-                        'length': entry['length'],
-                        'offset': entry['offset']
-                    }
-                    out.write(json.dumps(output_data).encode() + b'\n')
+        for index_file_path in sorted(glob(f'{index_dir}/cdx-*.gz')):
+            shard_id = get_shard_id(index_file_path)
+            output_file = f'{output_dir}/locations-{shard_id}.jsonl.bz2'
+            # Files which were scanned before the canonical urls last changed
+            # are scanned again
+            if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(args.urls_file):
+                jobs.append((index_file_path, output_file, file_to_blocks[os.path.basename(index_file_path)]))
+    logging.info(f'Scanning {len(jobs)} index files')
 
-                    # We only want to process each url once. There might be
-                    # multiple entries for the same canonical url
-                    urls.remove(canonical_url)
+    # Forking shares the url set with the workers instead of copying it
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.num_processes) as pool:
+        for index_file_path, num_found in tqdm(pool.imap_unordered(_scan_index_file, jobs), total=len(jobs)):
+            logging.info(f'Found {num_found} urls in {index_file_path}')
+    canonical_urls.close()
 
 
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
-    argp.add_argument('index_name')
-    argp.add_argument('index_file_path')
+    argp.add_argument('index_names', nargs='+')
+    argp.add_argument('--num-processes', type=int, default=1)
+    argp.add_argument('--urls-file', default='data/references/canonical-urls.bin',
+                      help='The file where the canonical urls are saved')
+    argp.add_argument('--use-cluster-index', action='store_true',
+                      help='Use each crawl\'s cluster.idx to only decompress the blocks which could contain the urls')
+    argp.add_argument('--low-memory', action='store_true',
+                      help='Check the urls against a Bloom filter and binary search the url file instead of '
+                           'building a set of the urls. This uses much less memory but more CPU.')
+    argp.add_argument('--bloom-error-rate', type=float, default=0.01,
+                      help='The false positive rate of the Bloom filter used by --low-memory')
     args = argp.parse_args()
     main(args)
@@ -1,48 +1,416 @@
 import bz2
 import json
+import mmap
 import os
+import signal
+import struct
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from glob import glob
-from threading import Thread
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# The compiled index is a single binary file laid out as
+#   header | records sorted by key | key bytes | json metadata
+# so that a lookup is a binary search over the fixed-width records without
+# ever loading the full key set into memory. The metadata has the list of
+# filenames and the path, size and modification time of every index file the
+# compiled index was built from, which is used to tell if it is stale.
+_compiled_index_magic = b'WCIDX003'
+_header_struct = struct.Struct('<8sQQQ')
+# key offset, key length, filename id (-1 if the write failed), block offset
+# (-1 if the file is not block-compressed), offset, length
+_record_struct = struct.Struct('<QIiqQQ')
+
+_read_chunk_size = 65536
+_default_max_buffer_bytes = 16 * 1024 * 1024
+_empty_stream = bz2.compress(b'')
+
+
+@contextmanager
+def _defer_signals():
+    # Delays SIGINT and SIGTERM until the end of the block so that a keyboard
+    # interrupt cannot kill the process in the middle of writing data, which
+    # would corrupt the file. Signal handlers can only be set from the main
+    # thread, so other threads are not protected.
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    received = []
+    signums = [signal.SIGINT, signal.SIGTERM]
+    previous_handlers = {signum: signal.signal(signum, lambda *args: received.append(args)) for signum in signums}
+    try:
+        yield
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        for signum, frame in received:
+            handler = previous_handlers[signum]
+            if callable(handler):
+                handler(signum, frame)
+            elif handler == signal.SIG_DFL:
+                os.kill(os.getpid(), signum)
+
+
+def _scan_streams(file_path: str) -> Iterator[Tuple[int, int, bytes]]:
+    # Yields the (start, end, uncompressed data) of every complete bz2 stream
+    # in the file. A partially written stream at the end is ignored.
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    start, position = 0, 0
+    with open(file_path, 'rb') as f:
+        compressed = f.read(_read_chunk_size)
+        while compressed:
+            try:
+                chunks.append(decompressor.decompress(compressed))
+            except OSError:
+                # The rest of the file is corrupt
+                return
+            if decompressor.eof:
+                unused_data = decompressor.unused_data
+                end = position + len(compressed) - len(unused_data)
+                yield start, end, b''.join(chunks)
+
+                decompressor = bz2.BZ2Decompressor()
+                chunks = []
+                start = position = end
+                compressed = unused_data
+            else:
+                position += len(compressed)
+                compressed = f.read(_read_chunk_size)
 
 
 class IndexedBz2FileWriter(object):
-    def __init__(self, file_path: str, index_file_path: str) -> None:
+    def __init__(self,
+                 file_path: str,
+                 index_file_path: str,
+                 block_size: int = None,
+                 buffer_size: int = 1000,
+                 recover: bool = False) -> None:
+        # If `block_size` is set, the data file is written as a sequence of
+        # independent bz2 streams of at most `block_size` uncompressed bytes
+        # (like the Wikipedia multistream dumps). Each index entry then also
+        # records the compressed offset of its stream, so reading one record
+        # only decompresses one block instead of the whole prefix of the file.
+        #
+        # Records are buffered and written `buffer_size` at a time. Every flush
+        # writes the data followed by the index as complete bz2 streams, so the
+        # files on disk are always valid up to the last flush. If `recover` is
+        # True, existing files are truncated to the last flush that was fully
+        # written and new records are appended to them.
         self.file_path = file_path
         self.index_file_path = index_file_path
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.recover = recover
+        self.max_buffer_bytes = block_size or _default_max_buffer_bytes
+        self.buffer = []
+        self.buffer_bytes = 0
         self.offset = 0
+        self.block_offset = 0
+        self.existing_keys = set()
 
     def __enter__(self) -> 'IndexedBz2FileWriter':
-        self.out = bz2.open(self.file_path, 'wb')
-        self.index_out = bz2.open(self.index_file_path, 'wb')
+        if self.recover and os.path.exists(self.file_path) and os.path.exists(self.index_file_path):
+            self._truncate_partial_writes()
+            self.out = open(self.file_path, 'ab')
+            self.index_out = open(self.index_file_path, 'ab')
+        else:
+            self.out = open(self.file_path, 'wb')
+            self.index_out = open(self.index_file_path, 'wb')
+        # An empty file is not a valid bz2 file, so empty files start with an
+        # empty stream in case nothing is ever flushed to them
+        for f in [self.out, self.index_out]:
+            if f.tell() == 0:
+                f.write(_empty_stream)
+                f.flush()
+        self.block_offset = self.out.tell()
         return self
 
     def __exit__(self, *args) -> None:
+        # The buffered records are all complete, so it is safe to write them
+        # even if we are exiting because of an exception
+        self.flush()
         self.out.close()
         self.index_out.close()
 
+    def _truncate_partial_writes(self) -> None:
+        index_end = 0
+        entries = []
+        for _, end, data in _scan_streams(self.index_file_path):
+            index_end = end
+            entries.extend(json.loads(line.decode()) for line in data.splitlines())
+
+        # The data is always written before its index entries, so the data
+        # file ends at or after the end of the last indexed record
+        data_end = 0
+        successful = [entry for entry in entries if entry['success']]
+        if successful:
+            if self.block_size is None:
+                self.offset = max(entry['offset'] + entry['length'] for entry in successful)
+                total = 0
+                for _, end, data in _scan_streams(self.file_path):
+                    total += len(data)
+                    if total >= self.offset:
+                        data_end = end
+                        break
+            else:
+                last_block_offset = max(entry['block_offset'] for entry in successful)
+                for start, end, _ in _scan_streams(self.file_path):
+                    if start == last_block_offset:
+                        data_end = end
+                        break
+            if data_end == 0:
+                raise Exception(f'{self.file_path} is missing data which is in {self.index_file_path}')
+
+        os.truncate(self.file_path, data_end)
+        os.truncate(self.index_file_path, index_end)
+        self.existing_keys = set(entry['key'] for entry in entries)
+
     def write(self, key: str, data: str) -> None:
-        def _write():
-            entry = {'key': key}
-            if data is not None:
-                length = self.out.write(data.encode())
-                entry['success'] = True
-                entry['filename'] = self.file_path
-                entry['offset'] = self.offset
-                entry['length'] = length
-                self.offset += length
+        encoded = data.encode() if data is not None else None
+        self.buffer.append((key, encoded))
+        if encoded is not None:
+            self.buffer_bytes += len(encoded)
+        if len(self.buffer) >= self.buffer_size or self.buffer_bytes >= self.max_buffer_bytes:
+            self.flush()
+
+    def _end_stream(self, compressor) -> None:
+        self.out.write(compressor.flush())
+        if self.block_size is not None:
+            self.block_offset = self.out.tell()
+            self.offset = 0
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+
+        with _defer_signals():
+            compressor = None
+            lines = []
+            for key, encoded in self.buffer:
+                entry = {'key': key}
+                if encoded is not None:
+                    # Records never span two blocks, so a full block is only
+                    # ended before the next record is written
+                    if self.block_size is not None and self.offset >= self.block_size:
+                        self._end_stream(compressor)
+                        compressor = None
+                    if compressor is None:
+                        compressor = bz2.BZ2Compressor()
+
+                    self.out.write(compressor.compress(encoded))
+                    if self.block_size is not None:
+                        entry['block_offset'] = self.block_offset
+                    entry['success'] = True
+                    entry['filename'] = self.file_path
+                    entry['offset'] = self.offset
+                    entry['length'] = len(encoded)
+                    self.offset += len(encoded)
+                else:
+                    entry['success'] = False
+                lines.append(json.dumps(entry).encode() + b'\n')
+
+            if compressor is not None:
+                self._end_stream(compressor)
+            self.out.flush()
+            os.fsync(self.out.fileno())
+
+            self.index_out.write(bz2.compress(b''.join(lines)))
+            self.index_out.flush()
+            os.fsync(self.index_out.fileno())
+
+            # Cleared before a deferred signal is delivered so that `__exit__`
+            # does not write the same records again
+            self.buffer.clear()
+            self.buffer_bytes = 0
+
+
+def _decompress_block(f, block_offset: int, end: int) -> bytes:
+    # Decompress only as much of the bz2 stream starting at `block_offset` as
+    # is needed to reach `end` bytes of uncompressed data
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    num_bytes = 0
+    f.seek(block_offset, 0)
+    while num_bytes < end and not decompressor.eof:
+        compressed = f.read(_read_chunk_size)
+        if not compressed:
+            break
+        chunk = decompressor.decompress(compressed)
+        chunks.append(chunk)
+        num_bytes += len(chunk)
+    return b''.join(chunks)
+
+
+def read_from_block(filename: str, block_offset: int, offset: int, length: int) -> bytes:
+    with open(filename, 'rb') as f:
+        return _decompress_block(f, block_offset, offset + length)[offset:offset + length]
+
+
+def _get_sources(index_file_paths: List[str]) -> List[List[Any]]:
+    sources = []
+    for index_file_path in sorted(index_file_paths):
+        stat = os.stat(index_file_path)
+        sources.append([index_file_path, stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+def _read_compiled_index_metadata(data) -> Optional[Dict[str, Any]]:
+    # Returns None if the data is not a compiled index of the current version
+    if len(data) < _header_struct.size:
+        return None
+    magic, _, _, metadata_offset = _header_struct.unpack_from(data, 0)
+    if magic != _compiled_index_magic:
+        return None
+    return json.loads(data[metadata_offset:].decode())
+
+
+def is_compiled_index_current(index_file_glob: str, compiled_index_path: str) -> bool:
+    # The compiled index is stale if an index file was added, removed or
+    # changed since it was built
+    if not os.path.exists(compiled_index_path):
+        return False
+    with open(compiled_index_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            metadata = _read_compiled_index_metadata(data)
+    return metadata is not None and metadata['sources'] == _get_sources(glob(index_file_glob))
+
+
+def compile_index(index_file_glob: str, compiled_index_path: str) -> int:
+    # Later index files take priority over earlier ones, which matches the
+    # behavior of loading every file into a dictionary
+    locations = {}
+    filenames = []
+    filename_ids = {}
+    index_file_paths = glob(index_file_glob)
+    # The sources are recorded before they are read so that a file which
+    # changes while it is being compiled makes the compiled index stale
+    sources = _get_sources(index_file_paths)
+    for index_file_path in index_file_paths:
+        with bz2.open(index_file_path, 'rb') as f:
+            for line in f:
+                data = json.loads(line.decode())
+                key = data['key'].encode()
+                if data['success']:
+                    filename = data['filename']
+                    if filename not in filename_ids:
+                        filename_ids[filename] = len(filenames)
+                        filenames.append(filename)
+                    block_offset = data.get('block_offset', -1)
+                    locations[key] = (filename_ids[filename], block_offset, data['offset'], data['length'])
+                else:
+                    locations[key] = (-1, -1, 0, 0)
+
+    keys = sorted(locations.keys())
+    records_offset = _header_struct.size
+    keys_offset = records_offset + len(keys) * _record_struct.size
+
+    # Write to a temporary file first so a partially written index is never
+    # mistaken for a complete one
+    temp_path = compiled_index_path + '.tmp'
+    with open(temp_path, 'wb') as out:
+        out.write(_header_struct.pack(_compiled_index_magic, len(keys), keys_offset, 0))
+        key_offset = 0
+        for key in keys:
+            filename_id, block_offset, offset, length = locations[key]
+            out.write(_record_struct.pack(key_offset, len(key), filename_id, block_offset, offset, length))
+            key_offset += len(key)
+        for key in keys:
+            out.write(key)
+
+        metadata_offset = out.tell()
+        out.write(json.dumps({'filenames': filenames, 'sources': sources}).encode())
+        out.seek(0)
+        out.write(_header_struct.pack(_compiled_index_magic, len(keys), keys_offset, metadata_offset))
+    os.replace(temp_path, compiled_index_path)
+    return len(keys)
+
+
+# A read-only, memory-mapped view of an index written by `compile_index`. It
+# supports the subset of the dictionary interface that the reader needs and
+# returns the same location dictionaries as the original index files.
+class CompiledIndex(object):
+    def __init__(self, compiled_index_path: str) -> None:
+        self.file = open(compiled_index_path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        metadata = _read_compiled_index_metadata(self.data)
+        if metadata is None:
+            raise Exception(f'{compiled_index_path} is not a compiled index')
+        _, self.num_records, self.keys_offset, _ = _header_struct.unpack_from(self.data, 0)
+        self.filenames = metadata['filenames']
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+    def _get_record(self, index: int):
+        return _record_struct.unpack_from(self.data, _header_struct.size + index * _record_struct.size)
+
+    def _get_key(self, record) -> bytes:
+        start = self.keys_offset + record[0]
+        return self.data[start:start + record[1]]
+
+    def _find(self, key: str):
+        key = key.encode()
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._get_record(mid)
+            mid_key = self._get_key(record)
+            if mid_key == key:
+                return record
+            if mid_key < key:
+                lo = mid + 1
             else:
-                entry['success'] = False
-            self.index_out.write(json.dumps(entry).encode() + b'\n')
+                hi = mid
+        return None
+
+    def __len__(self) -> int:
+        return self.num_records
 
-        # Hack to prevent keyboard interrupt from killing the process in
-        # the middle of writing data, which will corrupt the file
-        thread = Thread(target=_write)
-        thread.start()
-        thread.join()
+    def __contains__(self, key: str) -> bool:
+        return self._find(key) is not None
+
+    def get(self, key: str, default: Any = None) -> Optional[Dict[str, Any]]:
+        record = self._find(key)
+        if record is None:
+            return default
+
+        _, _, filename_id, block_offset, offset, length = record
+        if filename_id < 0:
+            return {'key': key, 'success': False}
+        location = {
+            'key': key,
+            'success': True,
+            'filename': self.filenames[filename_id],
+            'offset': offset,
+            'length': length
+        }
+        if block_offset >= 0:
+            location['block_offset'] = block_offset
+        return location
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        location = self.get(key)
+        if location is None:
+            raise KeyError(key)
+        return location
 
 
 class IndexedBz2FilesReader(object):
-    def __init__(self, index_file_glob: str) -> None:
+    def __init__(self, index_file_glob: str, compiled_index_path: str = None) -> None:
+        if compiled_index_path is not None:
+            # The compiled index is only rebuilt when the index files change,
+            # otherwise opening it is just a memory map
+            if not is_compiled_index_current(index_file_glob, compiled_index_path):
+                compile_index(index_file_glob, compiled_index_path)
+            self.locations = CompiledIndex(compiled_index_path)
+            return
+
         self.locations = {}
         for index_file_path in glob(index_file_glob):
             with bz2.open(index_file_path, 'rb') as f:
@@ -52,16 +420,81 @@ class IndexedBz2FilesReader(object):
                     self.locations[key] = data
 
     def read(self, key: str) -> str:
-        if key not in self.locations:
-            return None
-
-        location = self.locations[key]
-        if not location['success']:
+        location = self.locations.get(key)
+        if location is None or not location['success']:
             return None
 
         filename = location['filename']
         offset = location['offset']
         length = location['length']
+        if 'block_offset' in location:
+            return read_from_block(filename, location['block_offset'], offset, length).decode()
+
         with bz2.open(filename, 'rb') as f:
             f.seek(offset, 0)
             return f.read(length).decode()
+
+    def read_many(self, keys: Iterable[str], ordered: bool = True) -> Iterator[Tuple[str, Optional[str]]]:
+        # Reads many keys at once by grouping them by file and sorting them by
+        # their position in the file so that each file is opened once and
+        # decompressed in a single sequential pass. If `ordered` is False, each
+        # distinct key is yielded as soon as it is read. Otherwise, they are
+        # yielded in the order of `keys`, which requires buffering any records
+        # which were read before the ones requested earlier.
+        keys = list(keys)
+        if not ordered:
+            yield from self._read_many(set(keys))
+            return
+
+        remaining = Counter(keys)
+        results = {}
+        index = 0
+        for key, data in self._read_many(set(keys)):
+            results[key] = data
+            while index < len(keys) and keys[index] in results:
+                key = keys[index]
+                yield key, results[key]
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    del results[key]
+                index += 1
+
+    def _read_many(self, keys: Iterable[str]) -> Iterator[Tuple[str, Optional[str]]]:
+        file_to_entries = defaultdict(list)
+        block_compressed = {}
+        for key in keys:
+            location = self.locations.get(key)
+            if location is None or not location['success']:
+                yield key, None
+                continue
+            entry = (location.get('block_offset', 0), location['offset'], location['length'], key)
+            file_to_entries[location['filename']].append(entry)
+            block_compressed[location['filename']] = 'block_offset' in location
+
+        for filename, entries in file_to_entries.items():
+            entries.sort()
+            if block_compressed[filename]:
+                yield from self._read_blocks(filename, entries)
+            else:
+                with bz2.open(filename, 'rb') as f:
+                    # Seeking forward continues decompressing from the current
+                    # position rather than starting over
+                    for _, offset, length, key in entries:
+                        f.seek(offset, 0)
+                        yield key, f.read(length).decode()
+
+    def _read_blocks(self, filename: str, entries: List[Tuple[int, int, int, str]]) -> Iterator[Tuple[str, str]]:
+        with open(filename, 'rb') as f:
+            start = 0
+            while start < len(entries):
+                # Find all of the entries in the same block and decompress
+                # the block once for all of them
+                block_offset = entries[start][0]
+                end = start
+                while end < len(entries) and entries[end][0] == block_offset:
+                    end += 1
+                _, last_offset, last_length, _ = entries[end - 1]
+                block = _decompress_block(f, block_offset, last_offset + last_length)
+                for _, offset, length, key in entries[start:end]:
+                    yield key, block[offset:offset + length].decode()
+                start = end
@@ -4,15 +4,17 @@ import json
 import logging
 import nltk
 import os
-import subprocess
 import sys
-from joblib import Parallel, delayed
-from typing import Iterable, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, Optional, Tuple
 from unidecode import unidecode
 
+from wikicite.node_workers import NodeWorkerPool
+from wikicite.pipeline import executor_map, prefetch
 from wikicite.references.indexed_bz2_file import IndexedBz2FileWriter
 
 timeout = 60
+_unfluff_worker = os.path.join(os.path.dirname(__file__), 'unfluff_worker.js')
 logging.basicConfig(stream=sys.stderr, level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(module)s: %(message)s',)
 
@@ -25,48 +27,47 @@ def get_shard_id(html_file_path: str) -> str:
     return shard_id
 
 
-def parse_html(url: str, html: str) -> str:
-    if not os.path.exists('ext/unfluff/bin/unfluff'):
-        raise Exception('unfluff not installed. Run "sh scripts/setup.sh"')
-
-    devnull = open(os.devnull, 'w')
-    process = subprocess.Popen('node ext/unfluff/bin/unfluff'.split(),
-                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                               stderr=devnull)
+def parse_unfluff_output(output: Optional[str]) -> Optional[Dict[str, Any]]:
+    if output is None:
+        return None
     try:
-        stdout, _ = process.communicate(input=html.encode(), timeout=timeout)
-        data = json.loads(stdout.decode())
-
-        text = data['text']
-        paragraph_texts = text.split('\n\n')
-        paragraphs = []
-        for paragraph in paragraph_texts:
-            paragraph = unidecode(paragraph)
-            sentences = nltk.sent_tokenize(paragraph)
-            sentences = list(map(lambda s: s.strip(), filter(None, sentences)))
-            if len(sentences) > 0:
-                paragraphs.append(sentences)
-        data['paragraphs'] = paragraphs
-        return url, data
-    except (subprocess.TimeoutExpired, json.decoder.JSONDecodeError):
-        process.kill()
-        return url, None
-
-
-def data_generator(file_path: str, batch_size: int) -> Iterable[List[Tuple[str, str]]]:
-    batch = []
+        data = json.loads(output)
+    except json.decoder.JSONDecodeError:
+        return None
+
+    text = data['text']
+    paragraph_texts = text.split('\n\n')
+    paragraphs = []
+    for paragraph in paragraph_texts:
+        paragraph = unidecode(paragraph)
+        sentences = nltk.sent_tokenize(paragraph)
+        sentences = list(map(lambda s: s.strip(), filter(None, sentences)))
+        if len(sentences) > 0:
+            paragraphs.append(sentences)
+    data['paragraphs'] = paragraphs
+    return data
+
+
+def format_document(document: Tuple[str, Optional[str]]) -> Optional[str]:
+    # Runs in the process pool so that the sentence splitting and json
+    # encoding happen off of the main thread
+    canonical_url, output = document
+    data = parse_unfluff_output(output)
+    if data is None or len(data) == 0:
+        return None
+
+    output_data = {
+        'canonical_url': canonical_url,
+        **data
+    }
+    return json.dumps(output_data) + '\n'
+
+
+def load_html(file_path: str) -> Iterator[Tuple[str, str]]:
     with bz2.open(file_path, 'rb') as f:
         for line in f:
             data = json.loads(line.decode())
-            canonical_url = data['canonical_url']
-            html = data['html']
-            batch.append((canonical_url, html))
-            if len(batch) == batch_size:
-                yield batch
-                batch.clear()
-
-    if batch:
-        yield batch
+            yield data['canonical_url'], data['html']
 
 
 def main(args):
@@ -77,22 +78,34 @@ def main(args):
     output_index_file = os.path.join(output_dir, f'documents-{shard_id}-index.jsonl.bz2')
     os.makedirs(output_dir, exist_ok=True)
 
-    with IndexedBz2FileWriter(output_file, output_index_file) as out:
-        count = 0
-        logging.info('Starting to parse')
-        with Parallel(n_jobs=args.num_cores) as parallel:
-            for batch in data_generator(args.html_file_path, args.batch_size):
-                jobs = [delayed(parse_html)(url, html) for url, html in batch]
-                for canonical_url, data in parallel(jobs):
-                    if data is None or len(data) == 0:
+    if not os.path.exists('ext/unfluff/bin/unfluff'):
+        raise Exception('unfluff not installed. Run "sh scripts/setup.sh"')
+
+    # Every stage runs concurrently and hands its output to the next one
+    # through a queue of at most --queue-size items: the reader decompresses
+    # and decodes the html, the Unfluff workers extract the text, the process
+    # pool splits the sentences and encodes the json, and the main thread
+    # compresses and writes the documents. Unless --ordered is set, the
+    # documents are written in the order they finish since the output is
+    # indexed by url, so a slow page does not hold up the others.
+    with NodeWorkerPool(_unfluff_worker, args.num_workers, timeout,
+                        max_requests=args.max_requests, max_memory_mb=args.max_memory_mb) as pool:
+        with ProcessPoolExecutor(args.num_cores) as executor:
+            with IndexedBz2FileWriter(output_file, output_index_file, args.block_size) as out:
+                documents = prefetch(load_html(args.html_file_path), args.queue_size)
+                extracted = prefetch(pool.map(documents, ordered=args.ordered), args.queue_size)
+                extracted = ((canonical_url, (canonical_url, output)) for canonical_url, output in extracted)
+                formatted = prefetch(executor_map(executor, format_document, extracted,
+                                                  args.queue_size, ordered=args.ordered),
+                                     args.queue_size)
+
+                count = 0
+                logging.info('Starting to parse')
+                for canonical_url, output_string in formatted:
+                    if output_string is None:
                         logging.warn(f'Extracting body text from {canonical_url} returned None')
                         continue
 
-                    output_data = {
-                        'canonical_url': canonical_url,
-                        **data
-                    }
-                    output_string = json.dumps(output_data) + '\n'
                     out.write(canonical_url, output_string)
 
                     count += 1
@@ -105,7 +118,19 @@ def main(args):
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('html_file_path')
-    argp.add_argument('--num-cores', type=int, default=1)
-    argp.add_argument('--batch-size', type=int, default=100)
+    argp.add_argument('--num-workers', type=int, default=1,
+                      help='The number of Unfluff processes to extract with at once')
+    argp.add_argument('--num-cores', type=int, default=1,
+                      help='The number of processes which split the sentences')
+    argp.add_argument('--queue-size', type=int, default=1000,
+                      help='The maximum number of documents buffered between two stages')
+    argp.add_argument('--ordered', action='store_true',
+                      help='Write the documents in the same order as the html file')
+    argp.add_argument('--max-requests', type=int, default=10000,
+                      help='The number of documents an Unfluff process parses before it is restarted')
+    argp.add_argument('--max-memory-mb', type=float, default=2048,
+                      help='Unfluff processes which use more memory than this are restarted')
+    argp.add_argument('--block-size', type=int, default=1000000,
+                      help='The number of uncompressed bytes per independently compressed block')
     args = argp.parse_args()
     main(args)
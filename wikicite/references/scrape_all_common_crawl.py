@@ -0,0 +1,119 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+from glob import glob
+from typing import Any, Dict
+
+from wikicite.references.scrape_common_crawl import SharedTokenBucket, add_scraper_arguments, \
+    create_scraper, scrape_shard
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(module)s: %(message)s',)
+
+
+def load_state(state_file: str) -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state: Dict[str, Dict[str, Any]], state_file: str) -> None:
+    # Replace the file atomically so an interruption never leaves it corrupt
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as out:
+        out.write(json.dumps(state, indent=2))
+    os.replace(temp_file, state_file)
+
+
+def run_shard(locations_file_path: str, bucket: SharedTokenBucket, args) -> None:
+    scraper = create_scraper(args, bucket)
+    finished = scrape_shard(locations_file_path, scraper, args)
+
+    # The shard only succeeded if every range was scraped or was a permanent
+    # failure. Ranges which ran out of retries are tried again when the shard
+    # is rerun since they were never written to the output index.
+    if not finished or scraper.num_failures > 0:
+        sys.exit(1)
+
+
+def main(args):
+    state_dir = os.path.dirname(args.state_file)
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+    state = load_state(args.state_file)
+
+    pending = []
+    for locations_file_path in sorted(glob(args.locations_glob)):
+        shard_state = state.setdefault(locations_file_path, {'status': 'pending', 'attempts': 0})
+        if shard_state['status'] == 'done':
+            continue
+        if shard_state['status'] == 'failed':
+            if not args.retry_failed:
+                continue
+            shard_state['attempts'] = 0
+        shard_state['status'] = 'pending'
+        pending.append(locations_file_path)
+    save_state(state, args.state_file)
+    logging.info(f'Scraping {len(pending)} shards')
+
+    # All of the shards draw from the same QPS budget, so the total rate stays
+    # under `max_qps` regardless of how many shards are running
+    bucket = SharedTokenBucket(args.max_qps, args.burst)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < args.num_shards:
+                locations_file_path = pending.pop(0)
+                process = multiprocessing.Process(target=run_shard, args=(locations_file_path, bucket, args))
+                process.start()
+                running[process.sentinel] = (locations_file_path, process)
+                state[locations_file_path]['status'] = 'running'
+                logging.info(f'Started scraping {locations_file_path}')
+            save_state(state, args.state_file)
+
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                locations_file_path, process = running.pop(sentinel)
+                process.join()
+                shard_state = state[locations_file_path]
+                shard_state['attempts'] += 1
+                if process.exitcode == 0:
+                    shard_state['status'] = 'done'
+                    logging.info(f'Finished scraping {locations_file_path}')
+                elif shard_state['attempts'] < args.max_attempts:
+                    shard_state['status'] = 'pending'
+                    pending.append(locations_file_path)
+                    logging.warning(f'Scraping {locations_file_path} failed, retrying it later')
+                else:
+                    shard_state['status'] = 'failed'
+                    logging.error(f'Scraping {locations_file_path} failed {shard_state["attempts"]} times, giving up')
+            save_state(state, args.state_file)
+    except KeyboardInterrupt:
+        # The shards receive the interrupt as well and finish writing their
+        # buffered output, after which they can be resumed
+        logging.info('Terminating scraping')
+        for locations_file_path, process in running.values():
+            process.join()
+            state[locations_file_path]['status'] = 'pending'
+        save_state(state, args.state_file)
+
+    logging.info('Exiting')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--locations-glob', default='data/references/common-crawl-locations/*.bz2')
+    argp.add_argument('--state-file', default='data/references/html/scrape-state.json')
+    argp.add_argument('--num-shards', type=int, default=4,
+                      help='The number of shards to scrape at the same time')
+    argp.add_argument('--max-attempts', type=int, default=3,
+                      help='The number of times to try scraping a shard before giving up')
+    argp.add_argument('--retry-failed', action='store_true',
+                      help='Try the shards which previously ran out of attempts again')
+    add_scraper_arguments(argp)
+    args = argp.parse_args()
+    main(args)
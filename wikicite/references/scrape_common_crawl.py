@@ -1,17 +1,21 @@
+import aiohttp
 import argparse
+import asyncio
 import bz2
-import gzip
+import codecs
+import heapq
 import json
 import logging
+import multiprocessing
 import os
-import requests
+import random
+import re
 import sys
+import threading
 import time
-from glob import glob
+from collections import deque
 from io import BytesIO
-from requests_futures.sessions import FuturesSession
-from tqdm import tqdm
-from typing import Any, Dict, Iterable, List, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from warcio.archiveiterator import ArchiveIterator
 
 from wikicite.references.indexed_bz2_file import IndexedBz2FileWriter
@@ -19,94 +23,422 @@ from wikicite.references.indexed_bz2_file import IndexedBz2FileWriter
 logging.basicConfig(stream=sys.stderr, level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(module)s: %(message)s',)
 
-_num_errors = 0
-_max_errors = 20
+timeout = 60
+_retryable_status_codes = set([500, 502, 503, 504])
+_throttle_status_codes = set([429, 503])
+_base_url = 'https://commoncrawl.s3.amazonaws.com'
+_charset_regex = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+_decode_chunk_size = 65536
 
 
-def response_hook(response, *args, **kwargs):
-    # 206 means the response has a partial response as dictated by the headers
-    if response.status_code == 206:
-        raw_data = BytesIO(response.content)
-        for record in ArchiveIterator(raw_data):
-            # There should only be 1 record
-            try:
-                html = record.content_stream().read().decode()
-                response.data = html
-            except UnicodeDecodeError:
-                response.data = None
-            return
-    elif response.status_code == 429:
-        print('429')
-        sys.exit('429 status code')
-    else:
-        logging.warning(f'Non-206 response: {response.status_code}')
-        response.data = None
-        return
+class RetryableError(Exception):
+    def __init__(self, message: str, request: Tuple[str, int, int, List[Tuple[str, int, int]]]) -> None:
+        # `request` is the part of the range request which still needs to be
+        # scraped, since the records before the error were already returned
+        super().__init__(message)
+        self.request = request
+
+
+def get_record_charset(content: bytes) -> Optional[str]:
+    # Finds the charset in the Content-Type of the HTTP response, falling back
+    # to the WARC headers, and checks that Python knows how to decode it
+    for record in ArchiveIterator(BytesIO(content)):
+        for headers in [record.http_headers, record.rec_headers]:
+            if headers is None:
+                continue
+            match = _charset_regex.search(headers.get_header('Content-Type') or '')
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    pass
+        return None
+    return None
+
+
+def _decode_warc_record(content: bytes, encoding: str, errors: str, max_body_size: int = None) -> Optional[str]:
+    # Decodes the body incrementally so that the full decompressed body and
+    # the decoded string are never both in memory
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    for record in ArchiveIterator(BytesIO(content)):
+        # There should only be 1 record
+        stream = record.content_stream()
+        texts = []
+        num_bytes = 0
+        while True:
+            chunk = stream.read(_decode_chunk_size)
+            if not chunk:
+                texts.append(decoder.decode(b'', final=True))
+                break
+            if max_body_size is not None and num_bytes + len(chunk) >= max_body_size:
+                # Any partial character at the truncation point is dropped
+                texts.append(decoder.decode(chunk[:max_body_size - num_bytes]))
+                break
+            num_bytes += len(chunk)
+            texts.append(decoder.decode(chunk))
+        return ''.join(texts)
+    return None
+
+
+def parse_warc_record(content: bytes, max_body_size: int = None) -> Optional[str]:
+    # Try the declared charset and UTF-8 before falling back to replacing the
+    # bytes which cannot be decoded so that the document is not lost
+    charset = get_record_charset(content) or 'utf-8'
+    encodings = [charset] if charset == 'utf-8' else [charset, 'utf-8']
+    for encoding in encodings:
+        try:
+            return _decode_warc_record(content, encoding, 'strict', max_body_size)
+        except UnicodeDecodeError:
+            pass
+    return _decode_warc_record(content, charset, 'replace', max_body_size)
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float) -> None:
+        # Tokens are added at `rate` per second up to `capacity`, which is the
+        # largest burst of requests that can be sent at once
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.last_decrease = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    async def acquire(self) -> None:
+        # Sleep exactly until the next token is available rather than polling
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class SharedTokenBucket(object):
+    def __init__(self, rate: float, capacity: float) -> None:
+        # A token bucket whose state is in shared memory so that it enforces
+        # one QPS budget across several processes. Tokens are reserved
+        # immediately and the caller sleeps until its reservation is due,
+        # which keeps the processes from repeatedly waking up and racing for
+        # the same token.
+        self.capacity = capacity
+        self.lock = multiprocessing.Lock()
+        self._rate = multiprocessing.Value('d', rate, lock=False)
+        self._tokens = multiprocessing.Value('d', capacity, lock=False)
+        self._last_update = multiprocessing.Value('d', time.monotonic(), lock=False)
+        self._last_decrease = multiprocessing.Value('d', 0, lock=False)
+
+    @property
+    def rate(self) -> float:
+        return self._rate.value
+
+    @rate.setter
+    def rate(self, rate: float) -> None:
+        with self.lock:
+            self._rate.value = rate
+
+    @property
+    def last_decrease(self) -> float:
+        return self._last_decrease.value
+
+    @last_decrease.setter
+    def last_decrease(self, last_decrease: float) -> None:
+        with self.lock:
+            self._last_decrease.value = last_decrease
+
+    async def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self._tokens.value + (now - self._last_update.value) * self._rate.value)
+            self._tokens.value = tokens - 1
+            self._last_update.value = now
+            delay = (1 - tokens) / self._rate.value
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateController(object):
+    def __init__(self,
+                 bucket: TokenBucket,
+                 min_qps: float,
+                 max_qps: float,
+                 latency_target: float,
+                 window_size: int = 100,
+                 increase: float = 0.5,
+                 backoff_factor: float = 0.5,
+                 cooldown: float = 10) -> None:
+        # Adjusts the rate of the token bucket with additive increase and
+        # multiplicative decrease. The rate is cut by `backoff_factor` when the
+        # server responds with 429 or 503, at most once per `cooldown` seconds
+        # since one overload usually fails many requests which are already in
+        # flight. Every `window_size` successful requests, the rate is reduced
+        # slightly if the 95th percentile latency is above `latency_target`
+        # and otherwise increased by `increase` QPS up to `max_qps`.
+        self.bucket = bucket
+        self.min_qps = min_qps
+        self.max_qps = max_qps
+        self.latency_target = latency_target
+        self.window_size = window_size
+        self.increase = increase
+        self.backoff_factor = backoff_factor
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=window_size)
+        self.num_successes = 0
+
+    def _set_rate(self, rate: float, reason: str) -> None:
+        rate = min(self.max_qps, max(self.min_qps, rate))
+        if rate != self.bucket.rate:
+            logging.info(f'Changing QPS from {self.bucket.rate:.2f} to {rate:.2f} ({reason})')
+            self.bucket.rate = rate
+
+    def on_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.num_successes += 1
+        if self.num_successes % self.window_size == 0:
+            latencies = sorted(self.latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            if p95 > self.latency_target:
+                self._set_rate(self.bucket.rate * 0.9, f'p95 latency {p95:.2f}s')
+            else:
+                self._set_rate(self.bucket.rate + self.increase, f'p95 latency {p95:.2f}s')
+
+    def on_throttle(self) -> None:
+        # The time of the last decrease is kept on the bucket so that scrapers
+        # which share a bucket do not all back off for the same overload
+        now = time.monotonic()
+        if now - self.bucket.last_decrease >= self.cooldown:
+            self.bucket.last_decrease = now
+            self._set_rate(self.bucket.rate * self.backoff_factor, 'throttled by the server')
 
 
 class Scraper(object):
-    def __init__(self, num_workers: int, max_qps: float, window_length: float) -> None:
+    def __init__(self,
+                 num_workers: int,
+                 max_qps: float,
+                 burst: float = 1,
+                 min_qps: float = 0.1,
+                 latency_target: float = 10,
+                 max_retries: int = 5,
+                 base_backoff: float = 1,
+                 max_backoff: float = 300,
+                 bucket: TokenBucket = None,
+                 max_body_size: int = None) -> None:
+        # `num_workers` is the maximum number of requests in flight at once
+        # and the QPS is enforced by a token bucket that is shared by all of
+        # them, so a slow request only occupies its own worker. The QPS starts
+        # at `max_qps` and is adapted to the server's responses. Failed range
+        # requests are retried up to `max_retries` times after an exponential
+        # backoff with jitter while the workers continue with other requests.
+        # A `bucket` can be passed to share one QPS budget between scrapers.
+        # Bodies longer than `max_body_size` bytes are truncated.
         self.num_workers = num_workers
-        self.max_qps = max_qps
-        self.window_length = window_length
+        self.bucket = bucket or TokenBucket(max_qps, burst)
+        self.controller = RateController(self.bucket, min_qps, max_qps, latency_target)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_body_size = max_body_size
         self.num_queries = 0
+        self.num_failures = 0
         self.start = time.time()
-        self.session = FuturesSession(max_workers=num_workers)
-        self.session.hooks['response'] = response_hook
 
-    def _scrape_batch(self, requests: List[Tuple[str, str, int, int]]) -> Iterable[Tuple[str, Dict[str, str]]]:
-        futures = []
-        for url, request_url, offset, end_offset in requests:
-            future = self.session.get(request_url, headers={'Range': f'bytes={offset}-{end_offset}'})
-            futures.append(future)
+    async def _fetch(self,
+                     session: aiohttp.ClientSession,
+                     request: Tuple[str, int, int, List[Tuple[str, int, int]]],
+                     results: asyncio.Queue) -> None:
+        await self.bucket.acquire()
+        self.num_queries += 1
+        request_url, start, end, members = request
+        headers = {'Range': f'bytes={start}-{end}'}
+        num_done = 0
+        # The time spent waiting on the server. The timeout and the latency
+        # which the QPS is adapted to only count this time, not the time spent
+        # waiting for the consumer to take the results.
+        server_time = 0
 
-        for (url, _, _, _), future in zip(requests, futures):
+        async def wait_for_server(awaitable):
+            nonlocal server_time
+            wait_start = time.monotonic()
             try:
-                response = future.result()
-                if response.data is not None:
-                    yield url, response.data
-            except Exception as e:
-                logging.error(f'Exception in request: {type(e)}')
-                logging.error(f'Sleeping for 10 seconds')
-                time.sleep(10)
-                global _num_errors
-                _num_errors += 1
-                if _num_errors >= _max_errors:
-                    logging.error('Hit maximum number of errors, exiting')
-                    sys.exit('Hit maximum number of errors, exiting')
-
-    def scrape(self, requests: Iterable[Tuple[str, str, int, int]]) -> Iterable[Tuple[str, Dict[str, str]]]:
-        batch_size = self.num_workers
-        batch = []
-        for url, request_url, offset, end_offset in requests:
-            batch.append((url, request_url, offset, end_offset))
-            if len(batch) >= batch_size:
-                queries_in_batch = len(batch)
-
-                # Check if the window should be reset
-                elapsed = time.time() - self.start
-                if elapsed >= self.window_length:
-                    self.start = time.time()
-                    self.num_queries = 0
-
-                # Compute the effective QPS after sending these requests and
-                # sleep until it's below the maximum QPS
-                num_queries = self.num_queries + queries_in_batch
-                while (num_queries / (time.time() - self.start)) > self.max_qps:
-                    time.sleep(0.1)
-
-                # Now actually do the scraping
-                for url, html in self._scrape_batch(batch):
-                    yield url, html
-                self.num_queries += queries_in_batch
-
-                # Reset the batch for the next round
-                batch.clear()
-
-        # Clean up any leftover urls
-        if batch:
-            for url, html in self._scrape_batch(batch):
-                yield url, html
+                return await asyncio.wait_for(awaitable, timeout - server_time)
+            finally:
+                server_time += time.monotonic() - wait_start
+
+        try:
+            async with await wait_for_server(session.get(request_url, headers=headers)) as response:
+                # 206 means the response has a partial response as dictated by the headers
+                if response.status == 206:
+                    # Stream the coalesced range and split it back into the
+                    # individual records as they arrive, so only one record
+                    # is in memory at a time. The members are sorted by offset
+                    # and never overlap, except that several urls may share
+                    # the same record, which is only read once.
+                    position = start
+                    previous_range, content = None, None
+                    for url, offset, end_offset in members:
+                        if (offset, end_offset) != previous_range:
+                            if offset > position:
+                                await wait_for_server(response.content.readexactly(offset - position))
+                            content = await wait_for_server(response.content.readexactly(end_offset - offset + 1))
+                            position = end_offset + 1
+                            previous_range = (offset, end_offset)
+
+                        try:
+                            html = parse_warc_record(content, self.max_body_size)
+                        except Exception as e:
+                            # A bad record only fails its own url, which falls
+                            # back to its next capture if it has one
+                            logging.warning(f'Failed to parse the WARC record for {url} '
+                                            f'at {request_url} bytes {offset}-{end_offset}: {e}')
+                            html = None
+                        if html is not None:
+                            await results.put((url, html))
+                        num_done += 1
+                    self.controller.on_success(server_time)
+                    return
+
+                if response.status in _throttle_status_codes:
+                    self.controller.on_throttle()
+                if response.status in _retryable_status_codes or response.status == 429:
+                    raise RetryableError(f'{response.status} response', request)
+                logging.warning(f'Non-206 response: {response.status}')
+        except (asyncio.TimeoutError, aiohttp.ClientError, asyncio.IncompleteReadError) as e:
+            request_url, _, end, members = request
+            if num_done == len(members):
+                return
+            if isinstance(e, asyncio.TimeoutError):
+                # A timeout is most likely caused by an overloaded server
+                self.controller.on_throttle()
+            # Only retry the records which were not already returned
+            members = members[num_done:]
+            raise RetryableError(f'Exception in request: {type(e)}', (request_url, members[0][1], end, members))
+
+    def _schedule_retry(self, attempt: int, request: Tuple[str, int, int, List[Tuple[str, int, int]]]) -> None:
+        if attempt >= self.max_retries:
+            self.num_failures += 1
+            logging.warning(f'Giving up on {request[0]} bytes {request[1]}-{request[2]} after {attempt + 1} attempts')
+            return
+
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+        self.num_retries += 1
+        heapq.heappush(self.retries, (time.monotonic() + backoff, self.num_retries, attempt + 1, request))
+
+    async def _next_request(self, requests: Iterator[Tuple[str, int, int, List[Tuple[str, int, int]]]]):
+        # Returns the next (attempt, request) to send, prioritizing retries
+        # whose backoff has expired, or None if there is nothing left to do
+        while True:
+            now = time.monotonic()
+            if self.retries and self.retries[0][0] <= now:
+                _, _, attempt, request = heapq.heappop(self.retries)
+                return attempt, request
+            if not self.exhausted:
+                try:
+                    return 0, next(requests)
+                except StopIteration:
+                    self.exhausted = True
+            if not self.retries and self.num_in_flight == 0:
+                return None
+
+            # Wait for the next retry to be ready or for a request in flight
+            # to finish, since it might need to be retried
+            delay = self.retries[0][0] - now if self.retries else None
+            self.finished.clear()
+            try:
+                await asyncio.wait_for(self.finished.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self,
+                      session: aiohttp.ClientSession,
+                      requests: Iterator[Tuple[str, int, int, List[Tuple[str, int, int]]]],
+                      results: asyncio.Queue) -> None:
+        # All of the workers pull from the same iterator, which is safe because
+        # they all run on the same event loop
+        while True:
+            item = await self._next_request(requests)
+            if item is None:
+                return
+
+            attempt, request = item
+            self.num_in_flight += 1
+            try:
+                await self._fetch(session, request, results)
+            except RetryableError as e:
+                request_url, start, end, _ = e.request
+                logging.warning(f'{e} for {request_url} bytes {start}-{end}')
+                self._schedule_retry(attempt, e.request)
+            finally:
+                self.num_in_flight -= 1
+                self.finished.set()
+
+    async def _scrape(self,
+                      requests: Iterable[Tuple[str, int, int, List[Tuple[str, int, int]]]],
+                      results: asyncio.Queue) -> None:
+        cancelled = False
+        try:
+            # The requests are timed out in `_fetch` so that the time spent
+            # waiting on the consumer does not count
+            client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout)
+            async with aiohttp.ClientSession(timeout=client_timeout) as session:
+                requests = iter(requests)
+                workers = [asyncio.ensure_future(self._worker(session, requests, results))
+                           for _ in range(self.num_workers)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Signal the consumer that there are no more results. If the
+            # consumer cancelled the scraping, it is no longer reading them.
+            if not cancelled:
+                await results.put(None)
+
+    async def _start(self, requests: Iterable[Tuple[str, int, int, List[Tuple[str, int, int]]]]) -> Tuple[asyncio.Queue, asyncio.Task]:
+        results = asyncio.Queue(maxsize=self.num_workers)
+        self.retries = []
+        self.num_retries = 0
+        self.num_in_flight = 0
+        self.exhausted = False
+        self.finished = asyncio.Event()
+        task = asyncio.ensure_future(self._scrape(requests, results))
+        return results, task
+
+    @staticmethod
+    async def _cancel(task: asyncio.Task) -> None:
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+
+    def scrape(self, requests: Iterable[Tuple[str, int, int, List[Tuple[str, int, int]]]]) -> Iterable[Tuple[str, str]]:
+        # The event loop runs on a background thread so that requests stay in
+        # flight while the caller processes the results. The results queue is
+        # bounded, so the fetchers wait if the caller falls behind.
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        results, task = asyncio.run_coroutine_threadsafe(self._start(requests), loop).result()
+        try:
+            while True:
+                item = asyncio.run_coroutine_threadsafe(results.get(), loop).result()
+                if item is None:
+                    break
+                yield item
+            # Raises any exception which stopped the scraping
+            asyncio.run_coroutine_threadsafe(asyncio.wait_for(task, None), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(self._cancel(task), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
 
     def qps(self) -> Tuple[float, float, float]:
         elapsed = time.time() - self.start
@@ -122,26 +454,54 @@ def get_shard_id(locations_file_path: str) -> str:
     return shard_id
 
 
-def load_locations(locations_file: str) -> List[Tuple[str, str, int, int]]:
-    # Iterate over the directories in reversed order (reverse chronological) so
-    # the more recent pages have higher priority (do we want this ordering?)
+def load_locations(locations_file: str,
+                   base_url: str = _base_url) -> Tuple[List[Tuple[str, str, int, int]], Dict[str, List[Tuple[str, str, int, int]]]]:
+    # Returns the primary capture of each url and the fallback captures from
+    # other crawls, ordered from most to least preferred, which are scraped if
+    # the primary capture fails
     logging.info(f'Loading locations from {locations_file}')
     locations = []
+    fallbacks = {}
     with bz2.open(locations_file, 'rb') as f:
         for line in f:
             data = json.loads(line.decode())
             canonical_url = data['canonical_url']
-            filename = data['filename']
-            length = data['length']
-            offset = data['offset']
-            end_offset = offset + length - 1
-            request_url = f'https://commoncrawl.s3.amazonaws.com/{filename}'
-            locations.append((canonical_url, request_url, offset, end_offset))
-        return locations
+            captures = [data] + data.get('candidates', [])
+            captures = [(canonical_url, f'{base_url}/{capture["filename"]}',
+                         capture['offset'], capture['offset'] + capture['length'] - 1)
+                        for capture in captures]
+            locations.append(captures[0])
+            if len(captures) > 1:
+                fallbacks[canonical_url] = captures[1:]
+        return locations, fallbacks
 
 
-def main(args):
-    locations_file_path = args.locations_file_path
+def coalesce_locations(locations: List[Tuple[str, str, int, int]],
+                       max_gap: int,
+                       max_size: int) -> List[Tuple[str, int, int, List[Tuple[str, int, int]]]]:
+    # Merges the byte ranges of records which are near each other in the same
+    # WARC file into one (request_url, start, end, members) range request so
+    # that they can be downloaded with a single query. Ranges are merged if
+    # the gap between them is at most `max_gap` bytes and the merged range is
+    # at most `max_size` bytes. Overlapping ranges are never merged because
+    # the members of a request are read back to back, but identical ranges
+    # are, since their record is only read once.
+    ranges = []
+    for url, request_url, offset, end_offset in sorted(locations, key=lambda location: (location[1], location[2])):
+        if ranges:
+            last_request_url, start, end, members = ranges[-1]
+            same_range = (offset, end_offset) == members[-1][1:]
+            after_gap = end < offset and offset - end - 1 <= max_gap and end_offset - start + 1 <= max_size
+            if request_url == last_request_url and (same_range or after_gap):
+                members.append((url, offset, end_offset))
+                ranges[-1] = (request_url, start, max(end, end_offset), members)
+                continue
+        ranges.append((request_url, offset, end_offset, [(url, offset, end_offset)]))
+    return ranges
+
+
+def scrape_shard(locations_file_path: str, scraper: Scraper, args) -> bool:
+    # Returns True if every location in the shard was attempted
     shard_id = get_shard_id(locations_file_path)
 
     output_dir = 'data/references/html'
@@ -149,44 +509,102 @@ def main(args):
     output_index_file = f'{output_dir}/html-{shard_id}-index.jsonl.bz2'
     os.makedirs(output_dir, exist_ok=True)
 
-    locations = load_locations(locations_file_path)
-    scraper = Scraper(args.num_workers, args.max_qps, args.window_length)
+    locations, fallbacks = load_locations(locations_file_path, args.base_url)
     try:
-        with IndexedBz2FileWriter(output_file, output_index_file) as out:
-            found, total = 0, 0
-            for i, (canonical_url, html) in enumerate(scraper.scrape(locations)):
-                total += 1
-                if html:
-                    found += 1
-                    output_data = {
-                        'canonical_url': canonical_url,
-                        'html': html
-                    }
-                    output_string = json.dumps(output_data) + '\n'
-                    out.write(canonical_url, output_string)
-                else:
-                    out.write(canonical_url, None)
-
-                if (i + 1) % 1000 == 0:
-                    num_queries, elapsed, qps = scraper.qps()
-                    successful = found / total * 100
-                    logging.info(f'QPS: {qps:.2f}, Progress: {i + 1}, Successful: {found} / {total} = {successful:.2f}%')
+        with IndexedBz2FileWriter(output_file, output_index_file, args.block_size, recover=not args.restart) as out:
+            # Resume from where a previous run of this shard stopped by
+            # skipping everything which is already in the output index
+            done = set(out.existing_keys)
+            if done:
+                logging.info(f'Skipping {len(done)} urls which were already scraped')
+
+            # The urls which could not be scraped are tried again with their
+            # next capture until they succeed or run out of captures
+            attempt = 0
+            while locations:
+                locations = [location for location in locations if location[0] not in done]
+                ranges = coalesce_locations(locations, args.max_gap, args.max_range_size)
+                logging.info(f'Coalesced {len(locations)} locations into {len(ranges)} range requests')
+
+                found, total = 0, 0
+                for i, (canonical_url, html) in enumerate(scraper.scrape(ranges)):
+                    total += 1
+                    done.add(canonical_url)
+                    if html:
+                        found += 1
+                        output_data = {
+                            'canonical_url': canonical_url,
+                            'html': html
+                        }
+                        output_string = json.dumps(output_data) + '\n'
+                        out.write(canonical_url, output_string)
+                    else:
+                        out.write(canonical_url, None)
+
+                    if (i + 1) % 1000 == 0:
+                        num_queries, elapsed, qps = scraper.qps()
+                        successful = found / total * 100
+                        logging.info(f'QPS: {qps:.2f}, Progress: {i + 1}, Successful: {found} / {total} = {successful:.2f}%')
+
+                locations = [fallbacks[url][attempt] for url in fallbacks
+                             if url not in done and len(fallbacks[url]) > attempt]
+                attempt += 1
+                if locations:
+                    logging.info(f'Falling back to capture {attempt + 1} for {len(locations)} urls')
             logging.info(f'Finishing crawling {locations_file_path}')
+            return True
     except KeyboardInterrupt as e:
         logging.exception(e)
         logging.info('Terminating scraping')
     except Exception as e:
         logging.exception(e)
         logging.error('Terminating scraping due to exception')
+    return False
 
+
+def create_scraper(args, bucket: TokenBucket = None) -> Scraper:
+    return Scraper(args.num_workers, args.max_qps, args.burst,
+                   min_qps=args.min_qps,
+                   latency_target=args.latency_target,
+                   max_retries=args.max_retries,
+                   bucket=bucket,
+                   max_body_size=args.max_body_size)
+
+
+def main(args):
+    scraper = create_scraper(args)
+    scrape_shard(args.locations_file_path, scraper, args)
     logging.info('Exiting')
 
 
+def add_scraper_arguments(argp: argparse.ArgumentParser) -> None:
+    argp.add_argument('--num-workers', type=int, default=10,
+                      help='The maximum number of requests in flight at once')
+    argp.add_argument('--max-qps', type=float, default=10,
+                      help='The initial and maximum QPS. The QPS is lowered if the server is overloaded')
+    argp.add_argument('--min-qps', type=float, default=0.1)
+    argp.add_argument('--latency-target', type=float, default=10,
+                      help='The QPS is lowered when the 95th percentile latency in seconds is above this value')
+    argp.add_argument('--max-retries', type=int, default=5)
+    argp.add_argument('--burst', type=float, default=1,
+                      help='The maximum number of requests which can be sent at once without waiting on the QPS limit')
+    argp.add_argument('--max-gap', type=int, default=65536,
+                      help='The largest number of bytes between two records which will be requested together')
+    argp.add_argument('--max-range-size', type=int, default=2000000,
+                      help='The largest number of bytes which will be requested at once')
+    argp.add_argument('--max-body-size', type=int, default=10000000,
+                      help='The maximum number of bytes of a document body to keep')
+    argp.add_argument('--base-url', default=_base_url,
+                      help='The server which hosts the WARC files, e.g. a local server for testing')
+    argp.add_argument('--block-size', type=int, default=1000000,
+                      help='The number of uncompressed bytes per independently compressed block')
+    argp.add_argument('--restart', action='store_true',
+                      help='Overwrite any existing output instead of resuming from it')
+
+
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('locations_file_path')
-    argp.add_argument('--num-workers', type=int, default=10)
-    argp.add_argument('--max-qps', type=int, default=10)
-    argp.add_argument('--window-length', type=int, default=30)
+    add_scraper_arguments(argp)
     args = argp.parse_args()
     main(args)
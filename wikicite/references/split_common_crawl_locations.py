@@ -1,31 +1,189 @@
+import argparse
 import bz2
+import gzip
+import heapq
 import json
+import logging
+import math
+import os
+import sys
+import tempfile
 from glob import glob
+from itertools import groupby
 from tqdm import tqdm
+from typing import Any, Dict, Iterator, List, Tuple
 
-_urls_per_split = 50000
+logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(module)s: %(message)s',)
 
+# (canonical_url, rank, filename, offset, length) where a lower rank is a
+# more recent crawl
+Capture = Tuple[str, int, str, int, int]
 
-def main():
-    index_dir = 'data/references/common-crawl-locations'
 
-    locations = {}
-    # Iterate over the data in sorted order to prioritize the most recent crawl
-    for crawl_dir in tqdm(sorted(glob(f'{index_dir}/*')), desc='Reading locations'):
+def _write_run(items: List[Tuple], temp_dir: str, run_name: str) -> str:
+    items.sort()
+    run_file = f'{temp_dir}/{run_name}.jsonl.gz'
+    with gzip.open(run_file, 'wt', compresslevel=1) as out:
+        for item in items:
+            out.write(json.dumps(item) + '\n')
+    return run_file
+
+
+def _read_run(run_file: str) -> Iterator[List[Any]]:
+    with gzip.open(run_file, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def write_sorted_runs(index_dir: str, temp_dir: str, run_size: int) -> List[str]:
+    # Sorts the captures of every crawl by canonical url in runs of at most
+    # `run_size` captures, so only one run is in memory at a time
+    crawl_dirs = sorted(path for path in glob(f'{index_dir}/*') if os.path.isdir(path))
+    run_files = []
+    captures = []
+    # The crawl directories are named by date, so the last one is the most recent
+    for rank, crawl_dir in enumerate(tqdm(reversed(crawl_dirs), total=len(crawl_dirs), desc='Reading locations')):
         for index_file_path in tqdm(glob(f'{crawl_dir}/*.bz2')):
             with bz2.open(index_file_path, 'rb') as f:
                 for line in f:
                     data = json.loads(line.decode())
-                    canonical_url = data['canonical_url']
-                    locations[canonical_url] = line
+                    captures.append((data['canonical_url'], rank, data['filename'], data['offset'], data['length']))
+                    if len(captures) >= run_size:
+                        run_files.append(_write_run(captures, temp_dir, f'captures-{len(run_files)}'))
+                        captures = []
+    if captures:
+        run_files.append(_write_run(captures, temp_dir, f'captures-{len(run_files)}'))
+    return run_files
+
+
+def merge_captures(run_files: List[str], max_candidates: int) -> Iterator[Dict[str, Any]]:
+    # Merges the sorted runs and groups the captures of each url, which are
+    # ordered from the most to least recent crawl. The best capture is kept in
+    # the top-level fields and the next best in "candidates" so the scraper
+    # can fall back to them.
+    merged = heapq.merge(*[_read_run(run_file) for run_file in run_files])
+    for canonical_url, group in groupby(merged, key=lambda capture: capture[0]):
+        captures = []
+        seen = set()
+        for _, _, filename, offset, length in group:
+            # The same capture can be listed in more than one index file
+            if (filename, offset) in seen:
+                continue
+            seen.add((filename, offset))
+            captures.append({'filename': filename, 'length': length, 'offset': offset})
+            if len(captures) == max_candidates:
+                break
+        # The rest of the group is skipped by `groupby`
+
+        primary = captures[0]
+        yield {
+            'canonical_url': canonical_url,
+            'filename': primary['filename'],
+            'length': primary['length'],
+            'offset': primary['offset'],
+            'candidates': captures[1:]
+        }
+
+
+def write_shard(shard: List[Dict[str, Any]], output_file: str) -> None:
+    # Consecutive requests go to the same WARC file at increasing offsets
+    shard.sort(key=lambda data: (data['filename'], data['offset']))
+    with bz2.open(output_file, 'wb') as out:
+        for data in shard:
+            out.write(json.dumps(data).encode() + b'\n')
+
+
+def write_url_shards(records: Iterator[Dict[str, Any]], index_dir: str, urls_per_shard: int) -> int:
+    # Each shard has `urls_per_shard` consecutive urls
+    num_shards = 0
+    shard = []
+    for data in tqdm(records, desc='Writing locations'):
+        shard.append(data)
+        if len(shard) == urls_per_shard:
+            write_shard(shard, f'{index_dir}/locations-{num_shards}.jsonl.bz2')
+            num_shards += 1
+            shard = []
+    if shard:
+        write_shard(shard, f'{index_dir}/locations-{num_shards}.jsonl.bz2')
+        num_shards += 1
+    return num_shards
+
+
+def write_warc_shards(records: Iterator[Dict[str, Any]],
+                      index_dir: str,
+                      temp_dir: str,
+                      run_size: int,
+                      urls_per_shard: int) -> int:
+    # Each shard has a contiguous range of WARC files in sorted order, and
+    # the shards have about the same number of bytes to download rather than
+    # the same number of urls. The same number of shards as the url mode is
+    # written. The records are sorted by location with another external sort.
+    run_files = []
+    locations = []
+    num_urls, total_bytes = 0, 0
+    for data in tqdm(records, desc='Sorting locations'):
+        locations.append((data['filename'], data['offset'], data['length'], json.dumps(data)))
+        num_urls += 1
+        total_bytes += data['length']
+        if len(locations) >= run_size:
+            run_files.append(_write_run(locations, temp_dir, f'locations-{len(run_files)}'))
+            locations = []
+    if locations:
+        run_files.append(_write_run(locations, temp_dir, f'locations-{len(run_files)}'))
+
+    num_shards = max(math.ceil(num_urls / urls_per_shard), 1)
+    bytes_per_shard = total_bytes / num_shards
+    logging.info(f'Writing {num_shards} shards of about {bytes_per_shard:.0f} bytes each')
+
+    shard_id, written_bytes = 0, 0
+    out = None
+    merged = heapq.merge(*[_read_run(run_file) for run_file in run_files])
+    for _, group in tqdm(groupby(merged, key=lambda location: location[0]), desc='Writing locations'):
+        # Only start a new shard between WARC files. Comparing against the
+        # cumulative target keeps the rounding from accumulating.
+        if out is not None and written_bytes >= (shard_id + 1) * bytes_per_shard and shard_id + 1 < num_shards:
+            out.close()
+            out = None
+            shard_id += 1
+        if out is None:
+            out = bz2.open(f'{index_dir}/locations-{shard_id}.jsonl.bz2', 'wb')
+        for _, _, length, line in group:
+            out.write(line.encode() + b'\n')
+            written_bytes += length
+    if out is not None:
+        out.close()
+        shard_id += 1
+    return shard_id
+
+
+def main(args):
+    index_dir = args.index_dir
+    temp_dir = args.temp_dir or index_dir
+    with tempfile.TemporaryDirectory(dir=temp_dir) as run_dir:
+        run_files = write_sorted_runs(index_dir, run_dir, args.run_size)
+        logging.info(f'Merging {len(run_files)} sorted runs')
 
-    # Write all of the data to sharded files
-    values = list(locations.values())
-    for i, offset in enumerate(tqdm(range(0, len(values), _urls_per_split), desc='Writing locations')):
-        with bz2.open(f'{index_dir}/locations-{i}.jsonl.bz2', 'wb') as out:
-            for line in tqdm(values[offset:offset + _urls_per_split]):
-                out.write(line)
+        # Write all of the data to sharded files
+        records = merge_captures(run_files, args.max_candidates)
+        if args.shard_by == 'url':
+            num_shards = write_url_shards(records, index_dir, args.urls_per_shard)
+        else:
+            num_shards = write_warc_shards(records, index_dir, run_dir, args.run_size, args.urls_per_shard)
+    logging.info(f'Wrote {num_shards} shards')
 
 
 if __name__ == '__main__':
-    main()
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--index-dir', default='data/references/common-crawl-locations')
+    argp.add_argument('--temp-dir',
+                      help='The directory for the sorted runs. Defaults to the index directory')
+    argp.add_argument('--urls-per-shard', type=int, default=50000)
+    argp.add_argument('--run-size', type=int, default=1000000,
+                      help='The number of captures which are sorted in memory at once')
+    argp.add_argument('--shard-by', choices=['url', 'warc'], default='url',
+                      help='Split the urls into shards in url order or by WARC file, balancing the bytes per shard')
+    argp.add_argument('--max-candidates', type=int, default=3,
+                      help='The number of captures to keep per url, including the primary one')
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,12 @@
+// Extracts the body text from html with Unfluff for node_workers.py. Unfluff is
+// only loaded once instead of for every document.
+'use strict';
+
+const path = require('path');
+const serve = require('../node_worker').serve;
+const unfluff = require(path.resolve('ext/unfluff/lib/unfluff.js'));
+
+// The same output as `bin/unfluff`
+serve(function(html) {
+  return JSON.stringify(unfluff(html));
+});
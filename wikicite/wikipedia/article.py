@@ -1,5 +1,9 @@
 import re
+from array import array
 from collections import namedtuple
+from typing import Iterable, List, Tuple
+
+from wikicite.wikipedia.sentences import segment
 
 Citation = namedtuple('Citation', ['reference_id', 'offset'])
 
@@ -8,13 +12,14 @@ _heading_tags = set(['h2', 'h3', 'h4', 'h5', 'h6'])
 
 class Headings(object):
     def __init__(self):
-        self.headings = [''] * len(_heading_tags)
+        # The headings are a tuple which is replaced on every `add`, so the
+        # sections can share it instead of copying it
+        self.headings = ('',) * len(_heading_tags)
         self.previous_level = 0
 
     def add(self, header, level):
-        self.headings[level - 1] = header.strip()
-        for h in range(level, len(self.headings)):
-            self.headings[h] = ''
+        num_empty = len(self.headings) - level
+        self.headings = self.headings[:level - 1] + (header.strip(),) + ('',) * num_empty
 
         if level >= self.previous_level:
             self.previous_level = level
@@ -22,24 +27,38 @@ class Headings(object):
         return False
 
     def copy(self):
-        return self.headings[:]
+        return self.headings
 
     def __str__(self):
-        return str(self.headings)
+        return str(list(self.headings))
 
     def to_json(self):
-        return self.headings
+        return list(self.headings)
 
 
 class Article(object):
+    __slots__ = ['title', 'page_id', 'sections']
+
     def __init__(self, title: str, page_id: int):
         self.title = title
         self.page_id = page_id
         self.sections = []
 
+    @classmethod
+    def from_json(cls, data):
+        # The sections are built from the json up front so that the dict can
+        # be freed once the article is loaded
+        article = cls(data['title'], data['page_id'])
+        article.sections = [Section.from_json(section) for section in data['sections']]
+        return article
+
     def is_empty(self):
         return len(self.sections) == 0
 
+    def paragraphs(self):
+        for section in self.sections:
+            yield from section.paragraphs
+
     def to_json(self):
         return {
             'title': self.title,
@@ -49,61 +68,119 @@ class Article(object):
 
 
 class Section(object):
+    __slots__ = ['id', 'headings', 'paragraphs']
+
     def __init__(self, id_, headings):
         self.id = id_
         self.headings = headings
         self.paragraphs = []
 
+    @classmethod
+    def from_json(cls, data):
+        section = cls(data['id'], tuple(data['headings']))
+        section.paragraphs = [Paragraph.from_json(paragraph) for paragraph in data['paragraphs']]
+        return section
+
     def __bool__(self):
         return len(self.paragraphs) > 0
 
     def to_json(self):
         return {
             'id': self.id,
-            'headings': self.headings,
+            'headings': list(self.headings),
             'paragraphs': [paragraph.to_json() for paragraph in self.paragraphs]
         }
 
 
+def _pack_pairs(pairs):
+    packed = array('i')
+    for first, second in pairs:
+        packed.append(first)
+        packed.append(second)
+    return packed
+
+
 class Paragraph(object):
+    # The sentence offsets and citations are packed into flat int arrays of
+    # (start, end) and (reference_id, offset) pairs instead of lists of lists
+    # and namedtuples. The properties unpack them into new lists on every
+    # access, so code which only reads them should iterate the packed pairs.
+    __slots__ = ['id', 'text', '_sentence_offsets', '_citations']
+
     def __init__(self, id_, text, sentence_offsets, citations):
         self.id = id_
         self.text = text
         self.sentence_offsets = sentence_offsets
         self.citations = citations
 
+    @classmethod
+    def from_json(cls, data):
+        citations = ((citation['reference_id'], citation['offset']) for citation in data['citations'])
+        return cls(data['id'], data['text'], data['sentence_offsets'], citations)
+
+    @property
+    def sentence_offsets(self):
+        # Keep offsets as list to be consistent with the json deserialization
+        if self._sentence_offsets is None:
+            return None
+        packed = self._sentence_offsets
+        return [[start, end] for start, end in zip(packed[0::2], packed[1::2])]
+
+    @sentence_offsets.setter
+    def sentence_offsets(self, sentence_offsets):
+        self._sentence_offsets = None if sentence_offsets is None else _pack_pairs(sentence_offsets)
+
+    @property
+    def citations(self):
+        packed = self._citations
+        return [Citation(reference_id, offset) for reference_id, offset in zip(packed[0::2], packed[1::2])]
+
+    @citations.setter
+    def citations(self, citations):
+        self._citations = _pack_pairs(citations)
+
+    def reference_ids(self):
+        # The ids of the cited references without unpacking the citations
+        return self._citations[0::2]
+
     def to_json(self):
+        packed = self._citations
         return {
             'id': self.id,
             'text': self.text,
             'sentence_offsets': self.sentence_offsets,
             'citations': [
                 {
-                    'reference_id': citation.reference_id,
-                    'offset': citation.offset
+                    'reference_id': reference_id,
+                    'offset': offset
                 }
-                for citation in self.citations
+                for reference_id, offset in zip(packed[0::2], packed[1::2])
             ]
         }
 
 
+_heading_levels = {'h2': 1, 'h3': 2, 'h4': 3, 'h5': 4, 'h6': 5}
+_citation_pattern = re.compile(r'\[(\d+)\]')
+
+
+def get_heading_level(tag):
+    return _heading_levels.get(tag)
+
+
 def _get_header_level(node):
-    if node.tag == 'h2': return 1
-    if node.tag == 'h3': return 2
-    if node.tag == 'h4': return 3
-    if node.tag == 'h5': return 4
-    if node.tag == 'h6': return 5
-    return None
+    return get_heading_level(node.tag)
 
 
-def _parse_text(node):
+def parse_text_nodes(texts: Iterable[str]) -> Tuple[str, List[Citation]]:
+    # Joins the text nodes of a paragraph and replaces the citation markers
+    # like "[1]" with citations at their character offsets
     text = []
     citations = []
     offset = 0
-    for t in node.itertext():
+    for t in texts:
         if t.startswith('{{'):
             continue
-        match = re.match('\[(\d+)\]', t)
+        match = _citation_pattern.match(t)
         if match:
             reference_id = int(match.group(1))
             citations.append(Citation(reference_id, offset))
@@ -115,34 +192,68 @@ def _parse_text(node):
     return text, citations
 
 
+def _parse_text(node):
+    return parse_text_nodes(node.itertext())
+
+
+class ArticleBuilder(object):
+    def __init__(self, title: str, page_id: int):
+        # Builds an article from the top-level nodes of the html body in
+        # document order
+        self.article = Article(title, page_id)
+        self.headings = Headings()
+        self.section = Section(len(self.article.sections), self.headings.copy())
+        self.has_list = False
+
+    def add_list(self):
+        self.has_list = True
+
+    def add_paragraph(self, text, citations):
+        text = text.strip()
+        if text:
+            paragraph_id = len(self.section.paragraphs)
+            paragraph = Paragraph(paragraph_id, text, None, citations)
+            self.section.paragraphs.append(paragraph)
+
+    def add_heading(self, heading, level):
+        if self.section and not self.has_list:
+            self.article.sections.append(self.section)
+        self.headings.add(heading, level)
+        self.section = Section(len(self.article.sections), self.headings.copy())
+        self.has_list = False
+
+    def finish(self):
+        if self.section:
+            self.article.sections.append(self.section)
+        return self.article
+
+
+def segment_sentences(nlp, articles: List[Article], batch_size: int = 256, n_process: int = 1) -> None:
+    # Sets the `sentence_offsets` of every paragraph in the articles by
+    # running all of their text through the pipeline together
+    paragraphs = [paragraph for article in articles for paragraph in article.paragraphs()]
+    texts = (paragraph.text for paragraph in paragraphs)
+    for paragraph, sentence_offsets in zip(paragraphs, segment(nlp, texts, batch_size, n_process)):
+        paragraph.sentence_offsets = sentence_offsets
+
+
 def parse_article(nlp, title: str, page_id: int, tree):
+    # If `nlp` is None, the paragraphs' `sentence_offsets` are left as None so
+    # that the sentences of many articles can be split in batches with
+    # `segment_sentences`
     body = tree.xpath('body')[0]
 
-    article = Article(title, page_id)
-    headings = Headings()
-    section = Section(len(article.sections), headings.copy())
-    has_list = False
+    builder = ArticleBuilder(title, page_id)
     for node in body.getchildren():
         if node.tag in ['ul']:
-            has_list = True
+            builder.add_list()
         if node.tag in ['p']:
             text, citations = _parse_text(node)
-            text = text.strip()
-            if text:
-                # Keep offsets as list to be consistent with the json deserialization
-                sentence_offsets = [[sent.start_char, sent.end_char] for sent in nlp(text).sents]
-                paragraph_id = len(section.paragraphs)
-                paragraph = Paragraph(paragraph_id, text, sentence_offsets, citations)
-                section.paragraphs.append(paragraph)
+            builder.add_paragraph(text, citations)
         elif node.tag in _heading_tags:
-            level = _get_header_level(node)
-            if section and not has_list:
-                article.sections.append(section)
-            heading = node.text_content()
-            headings.add(heading, level)
-            section = Section(len(article.sections), headings.copy())
-            has_list = False
-
-    if section:
-        article.sections.append(section)
+            builder.add_heading(node.text_content(), _get_header_level(node))
+
+    article = builder.finish()
+    if nlp is not None:
+        segment_sentences(nlp, [article])
     return article
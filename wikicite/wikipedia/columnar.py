@@ -0,0 +1,227 @@
+import numpy as np
+from typing import Any, Dict, Iterator, List
+
+# A shard of articles stored as one column per field in an npz file. Every
+# table is a set of columns with one row per item, and the rows of a child
+# table which belong to row i of its parent are
+#   child[parent_offsets[i]:parent_offsets[i + 1]]
+# The tables are
+#   article:   page_id, title, section_offsets, reference_offsets
+#   section:   id, headings (the 5 levels of every section, flattened),
+#              paragraph_offsets
+#   paragraph: id, text, sentence_offsets, citation_offsets
+#   sentence:  start, end
+#   citation:  reference_id, offset
+#   reference: id, type, title, url, date
+# Strings are stored as the concatenated utf-8 bytes in `<name>_data` and the
+# start of every string in `<name>_offsets`. Empty strings stand for missing
+# reference fields.
+_num_heading_levels = 5
+_reference_fields = ['type', 'title', 'url', 'date']
+
+
+class StringColumn(object):
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.data[start:end].tobytes().decode()
+
+    def __iter__(self) -> Iterator[str]:
+        data = self.data.tobytes()
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            yield data[start:end].decode()
+
+
+class _StringColumnBuilder(object):
+    def __init__(self) -> None:
+        self.values = []
+
+    def append(self, value: str) -> None:
+        self.values.append(value.encode())
+
+    def save(self, name: str, columns: Dict[str, np.ndarray]) -> None:
+        offsets = np.zeros(len(self.values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in self.values], out=offsets[1:])
+        columns[f'{name}_data'] = np.frombuffer(b''.join(self.values), dtype=np.uint8)
+        columns[f'{name}_offsets'] = offsets
+
+
+def _to_offsets(counts: List[int]) -> np.ndarray:
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+class ColumnarArticleWriter(object):
+    def __init__(self, file_path: str) -> None:
+        # Collects the articles of a shard in lists and writes all of the
+        # columns when it is closed
+        self.file_path = file_path
+        self.ints = {name: [] for name in [
+            'article_page_id', 'section_id', 'paragraph_id',
+            'sentence_start', 'sentence_end',
+            'citation_reference_id', 'citation_offset',
+            'reference_id'
+        ]}
+        # The number of children of every row, which become the offsets
+        self.counts = {name: [] for name in [
+            'article_section_offsets', 'article_reference_offsets',
+            'section_paragraph_offsets',
+            'paragraph_sentence_offsets', 'paragraph_citation_offsets'
+        ]}
+        self.strings = {name: _StringColumnBuilder() for name in [
+            'article_title', 'section_headings', 'paragraph_text'
+        ] + [f'reference_{field}' for field in _reference_fields]}
+
+    def __enter__(self) -> 'ColumnarArticleWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, article: Dict[str, Any]) -> None:
+        # Adds an article in the `Article.to_json()` format with its references
+        ints, counts, strings = self.ints, self.counts, self.strings
+        ints['article_page_id'].append(article['page_id'])
+        strings['article_title'].append(article['title'])
+        counts['article_section_offsets'].append(len(article['sections']))
+        for section in article['sections']:
+            ints['section_id'].append(section['id'])
+            assert len(section['headings']) == _num_heading_levels
+            for heading in section['headings']:
+                strings['section_headings'].append(heading)
+            counts['section_paragraph_offsets'].append(len(section['paragraphs']))
+            for paragraph in section['paragraphs']:
+                ints['paragraph_id'].append(paragraph['id'])
+                strings['paragraph_text'].append(paragraph['text'])
+                counts['paragraph_sentence_offsets'].append(len(paragraph['sentence_offsets']))
+                for start, end in paragraph['sentence_offsets']:
+                    ints['sentence_start'].append(start)
+                    ints['sentence_end'].append(end)
+                counts['paragraph_citation_offsets'].append(len(paragraph['citations']))
+                for citation in paragraph['citations']:
+                    ints['citation_reference_id'].append(citation['reference_id'])
+                    ints['citation_offset'].append(citation['offset'])
+
+        counts['article_reference_offsets'].append(len(article['references']))
+        for id_, reference in article['references'].items():
+            ints['reference_id'].append(int(id_))
+            for field in _reference_fields:
+                strings[f'reference_{field}'].append(reference.get(field, ''))
+
+    def close(self) -> None:
+        columns = {}
+        for name, values in self.ints.items():
+            dtype = np.int64 if name == 'article_page_id' else np.int32
+            columns[name] = np.array(values, dtype=dtype)
+        for name, values in self.counts.items():
+            columns[name] = _to_offsets(values)
+        for name, builder in self.strings.items():
+            builder.save(name, columns)
+
+        with open(self.file_path, 'wb') as f:
+            np.savez_compressed(f, **columns)
+
+
+class ColumnarArticles(object):
+    def __init__(self, file_path: str) -> None:
+        # The columns are only read from the file when they are first used
+        self.file = np.load(file_path)
+        self.columns = {}
+
+    def __enter__(self) -> 'ColumnarArticles':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __len__(self) -> int:
+        return len(self['article_page_id'])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.columns:
+            self.columns[name] = self.file[name]
+        return self.columns[name]
+
+    def strings(self, name: str) -> StringColumn:
+        return StringColumn(self[f'{name}_data'], self[f'{name}_offsets'])
+
+    def parents(self, offsets_name: str) -> np.ndarray:
+        # Returns the parent row of every row in a child table, for example
+        # `parents('article_reference_offsets')` is the article of every
+        # reference, so that the parents' columns can be used to filter the
+        # children without a loop
+        offsets = self[offsets_name]
+        return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    def _reference(self, index: int, reference_fields: List[StringColumn]) -> Dict[str, str]:
+        reference = {}
+        for field, column in zip(_reference_fields, reference_fields):
+            value = column[index]
+            if value:
+                reference[field] = value
+        return reference
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        # Yields every article in the `Article.to_json()` format with its
+        # references, like the jsonl files. The reference ids are strings
+        # like they are after the json deserialization.
+        titles = self.strings('article_title')
+        headings = self.strings('section_headings')
+        texts = self.strings('paragraph_text')
+        reference_fields = [self.strings(f'reference_{field}') for field in _reference_fields]
+        section_offsets = self['article_section_offsets']
+        reference_offsets = self['article_reference_offsets']
+        paragraph_offsets = self['section_paragraph_offsets']
+        sentence_offsets = self['paragraph_sentence_offsets']
+        citation_offsets = self['paragraph_citation_offsets']
+        section_ids = self['section_id']
+        paragraph_ids = self['paragraph_id']
+        sentence_starts, sentence_ends = self['sentence_start'], self['sentence_end']
+        citation_reference_ids, citation_offsets_ = self['citation_reference_id'], self['citation_offset']
+        reference_ids = self['reference_id']
+
+        for a, page_id in enumerate(self['article_page_id']):
+            sections = []
+            for s in range(section_offsets[a], section_offsets[a + 1]):
+                paragraphs = []
+                for p in range(paragraph_offsets[s], paragraph_offsets[s + 1]):
+                    sentences = range(sentence_offsets[p], sentence_offsets[p + 1])
+                    citations = range(citation_offsets[p], citation_offsets[p + 1])
+                    paragraphs.append({
+                        'id': int(paragraph_ids[p]),
+                        'text': texts[p],
+                        'sentence_offsets': [[int(sentence_starts[i]), int(sentence_ends[i])] for i in sentences],
+                        'citations': [
+                            {
+                                'reference_id': int(citation_reference_ids[i]),
+                                'offset': int(citation_offsets_[i])
+                            }
+                            for i in citations
+                        ]
+                    })
+                sections.append({
+                    'id': int(section_ids[s]),
+                    'headings': [headings[s * _num_heading_levels + h] for h in range(_num_heading_levels)],
+                    'paragraphs': paragraphs
+                })
+
+            references = {
+                str(reference_ids[r]): self._reference(r, reference_fields)
+                for r in range(reference_offsets[a], reference_offsets[a + 1])
+            }
+            yield {
+                'title': titles[a],
+                'page_id': int(page_id),
+                'sections': sections,
+                'references': references
+            }
@@ -0,0 +1,51 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+from typing import Tuple
+
+from wikicite.wikipedia.extract_wikitext import _index_file, extract_shard, load_offsets
+
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+# The offsets are loaded once by the main process and then inherited by the
+# worker processes
+_offset_pairs = None
+
+
+def _extract_shard(job: Tuple[int, int, str]) -> Tuple[int, int]:
+    num_shards, shard_id, output_file = job
+    return shard_id, extract_shard(_offset_pairs, num_shards, shard_id, output_file)
+
+
+def main(args):
+    global _offset_pairs
+    _offset_pairs = load_offsets(_index_file)
+
+    output_dir = 'data/wikipedia/wikitext'
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Shards which were finished by a previous run are skipped
+    jobs = []
+    for shard_id in range(args.num_shards):
+        output_file = os.path.join(output_dir, f'wikitext-{shard_id}.jsonl.bz2')
+        if not os.path.exists(output_file):
+            jobs.append((args.num_shards, shard_id, output_file))
+    logging.info(f'Extracting {len(jobs)} shards with {args.num_processes} processes')
+
+    # Each process decompresses and parses the blocks of one shard at a time
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.num_processes) as pool:
+        for shard_id, count in pool.imap_unordered(_extract_shard, jobs):
+            logging.info(f'Finished shard {shard_id} with {count} entries')
+
+    logging.info('Terminating')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--num-shards', type=int, default=1000)
+    argp.add_argument('--num-processes', type=int, default=os.cpu_count())
+    args = argp.parse_args()
+    main(args)
@@ -4,12 +4,16 @@ import json
 import logging
 import os
 import sys
-from io import BytesIO
+from array import array
+from bz2 import BZ2Decompressor
 from lxml import etree
-from typing import List, Optional, T, Tuple
+from typing import Iterator, List, Optional, T, Tuple
 
 _multistream_file = 'data/wikipedia/xml/enwiki-20190101-pages-articles-multistream.xml.bz2'
 _index_file = 'data/wikipedia/xml/enwiki-20190101-pages-articles-multistream-index.txt.bz2'
+_read_chunk_size = 65536
+_mediawiki_end_tag = b'</mediawiki>'
+_end_tag_whitespace_margin = 64
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
@@ -35,6 +39,25 @@ def load_offsets_from_index(index_file_path: str) -> List[Tuple[int, int]]:
     return pairs
 
 
+def load_offsets(index_file_path: str) -> List[Tuple[int, Optional[int]]]:
+    # Decompressing the index takes several minutes, so the block offsets are
+    # cached in a binary file next to it the first time they are loaded
+    offsets_file_path = f'{index_file_path}.offsets'
+    if os.path.exists(offsets_file_path):
+        starts = array('q')
+        with open(offsets_file_path, 'rb') as f:
+            starts.frombytes(f.read())
+        return list(zip(starts, list(starts[1:]) + [None]))
+
+    pairs = load_offsets_from_index(index_file_path)
+    starts = array('q', [start for start, _ in pairs])
+    temp_file = offsets_file_path + '.tmp'
+    with open(temp_file, 'wb') as out:
+        out.write(starts.tobytes())
+    os.replace(temp_file, offsets_file_path)
+    return pairs
+
+
 def shard_data(data: List[T],
                num_shards: int,
                shard_id: int) -> List[T]:
@@ -44,50 +67,86 @@ def shard_data(data: List[T],
     return shard_data
 
 
-def load_wikitext_from_multistream(multistream_file_path: str,
-                                   start: int,
-                                   end: Optional[int] = None) -> List[str]:
+def _read_multistream(multistream_file_path: str,
+                      start: int,
+                      end: Optional[int] = None) -> Iterator[bytes]:
+    # Yields the decompressed bytes of the bz2 streams between `start` and
+    # `end` (or the end of the file) one chunk at a time
     with open(multistream_file_path, 'rb') as byte_f:
         byte_f.seek(start, 0)
-        if end is not None:
-            # Since we know what chunk we need to process, read the entire
-            # block into memory
-            num_bytes = end - start
-            compressed_bytes = byte_f.read(num_bytes)
-            stream_bytes = bz2.open(BytesIO(compressed_bytes), 'rb').read()
-        else:
-            # The end of the file will also contain an extra </mediawiki> tag
-            # that will mess up the parsing unless it's removed
-            stream_bytes = bz2.open(byte_f, 'rb').read()
-            stream_bytes = stream_bytes[:-len(b'</mediawiki>')]
-
-        # The `stream_bytes` contain multiple <page> tags, which serve as the root.
-        # I don't know if the lxml library can parse multiple xmls within
-        # the same byte stream. A hacky fix is to wrap the xmls in a new tag
-        # so the library will parse it correctly.
-        stream_bytes = b'<pages>\n' + stream_bytes + b'</pages>'
-        wikitexts = []
-        for _, page in etree.iterparse(BytesIO(stream_bytes), tag='page'):
-            title = page.xpath('title')[0].text
-            page_id = int(page.xpath('id')[0].text)
-            wikitext = page.xpath('revision/text')
-            wikitexts.append((title, page_id, wikitext[0].text))
-        return wikitexts
+        remaining = None if end is None else end - start
+        decompressor = BZ2Decompressor()
+        while remaining is None or remaining > 0:
+            chunk_size = _read_chunk_size if remaining is None else min(_read_chunk_size, remaining)
+            compressed_bytes = byte_f.read(chunk_size)
+            if not compressed_bytes:
+                break
+            if remaining is not None:
+                remaining -= len(compressed_bytes)
+
+            while compressed_bytes:
+                yield decompressor.decompress(compressed_bytes)
+                # The block may contain more than one bz2 stream
+                if decompressor.eof:
+                    compressed_bytes = decompressor.unused_data
+                    decompressor = BZ2Decompressor()
+                else:
+                    compressed_bytes = b''
 
 
-def main(args):
-    shard_id = args.shard_id
-    num_shards = args.num_shards
-
-    offset_pairs = load_offsets_from_index(_index_file)
+def load_wikitext_from_multistream(multistream_file_path: str,
+                                   start: int,
+                                   end: Optional[int] = None) -> Iterator[Tuple[str, int, str]]:
+    # The block contains multiple <page> tags, which serve as the root, so
+    # they are wrapped in a new tag to be parsed as one document. The
+    # decompressed bytes are fed to the parser as they are read and each page
+    # is cleared once it has been yielded so the block is never fully in memory.
+    parser = etree.XMLPullParser(events=('end',), tag='page')
+    parser.feed(b'<pages>\n')
+
+    # The end of the file will also contain an extra </mediawiki> tag that will
+    # mess up the parsing unless it's removed, so the last bytes are held back
+    # until it is known whether they are the end of the file. The tag may be
+    # followed by whitespace, so a few more bytes than the tag are held back.
+    num_held_back = len(_mediawiki_end_tag) + _end_tag_whitespace_margin
+    tail = b''
+    for stream_bytes in _read_multistream(multistream_file_path, start, end):
+        stream_bytes = tail + stream_bytes
+        tail = stream_bytes[-num_held_back:]
+        parser.feed(stream_bytes[:-num_held_back])
+        yield from _read_pages(parser)
+
+    if tail.rstrip().endswith(_mediawiki_end_tag):
+        tail = tail.rstrip()[:-len(_mediawiki_end_tag)]
+    parser.feed(tail + b'</pages>')
+    yield from _read_pages(parser)
+    parser.close()
+
+
+def _read_pages(parser: etree.XMLPullParser) -> Iterator[Tuple[str, int, str]]:
+    for _, page in parser.read_events():
+        title = page.xpath('title')[0].text
+        page_id = int(page.xpath('id')[0].text)
+        wikitext = page.xpath('revision/text')
+        yield title, page_id, wikitext[0].text
+
+        # Free the finished page and any earlier ones
+        page.clear()
+        while page.getprevious() is not None:
+            del page.getparent()[0]
+
+
+def extract_shard(offset_pairs: List[Tuple[int, Optional[int]]],
+                  num_shards: int,
+                  shard_id: int,
+                  output_file: str) -> int:
     shard_pairs = shard_data(offset_pairs, num_shards, shard_id)
 
-    output_dir = 'data/wikipedia/wikitext'
-    output_file = os.path.join(output_dir, f'wikitext-{shard_id}.jsonl.bz2')
-    os.makedirs(output_dir, exist_ok=True)
-
     logging.info(f'Processing {len(shard_pairs)} groups')
-    with bz2.open(output_file, 'wb') as out:
+    # The output is written to a temporary file so that a shard which exists
+    # is always complete
+    temp_file = output_file + '.tmp'
+    with bz2.open(temp_file, 'wb') as out:
         count = 0
         for start, end in shard_pairs:
             wikitexts = load_wikitext_from_multistream(_multistream_file, start, end)
@@ -112,7 +171,21 @@ def main(args):
                 count += 1
                 if count % 1000 == 0:
                     logging.info(f'Processed {count} entries')
+    os.replace(temp_file, output_file)
+    return count
+
+
+def main(args):
+    shard_id = args.shard_id
+    num_shards = args.num_shards
+
+    offset_pairs = load_offsets(_index_file)
+
+    output_dir = 'data/wikipedia/wikitext'
+    output_file = os.path.join(output_dir, f'wikitext-{shard_id}.jsonl.bz2')
+    os.makedirs(output_dir, exist_ok=True)
 
+    extract_shard(offset_pairs, num_shards, shard_id, output_file)
     logging.info('Terminating')
 
 
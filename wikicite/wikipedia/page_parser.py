@@ -0,0 +1,103 @@
+import lxml.etree
+from typing import Dict, Tuple
+
+from wikicite.wikipedia.article import Article, ArticleBuilder, get_heading_level, parse_text_nodes
+from wikicite.wikipedia.reference import References, parse_reference_templates
+
+
+class _Node(object):
+    __slots__ = ['tag', 'attrib', 'reference_id', 'is_reference_text']
+
+    def __init__(self, tag: str, attrib: Dict[str, str]) -> None:
+        self.tag = tag
+        self.attrib = attrib
+        # The id of the reference if this is an <li> in the reference list
+        self.reference_id = None
+        # Whether this is the <span class="mw-reference-text"> of a reference
+        self.is_reference_text = False
+
+
+class _PageTarget(object):
+    # An lxml parser target which builds the article and collects the
+    # references' templates while the html is parsed, without building a
+    # tree. It finds the same nodes as `parse_article` and
+    # `parse_references`: the paragraphs, lists and headings which are
+    # children of the body and the first `span[@data-mw]` of every
+    # `//ol[contains(@class, 'mw-references')]/li`.
+    def __init__(self, title: str, page_id: int) -> None:
+        self.builder = ArticleBuilder(title, page_id)
+        self.stack = []
+        # The text since the last tag, which becomes one text node like in
+        # the tree. Comments are dropped, so the text around them is merged
+        # like `strip_tags` does.
+        self.text = []
+        # The text nodes of the top-level paragraph or heading which is open
+        self.text_nodes = None
+        self.num_references = 0
+        self.templates = {}
+
+    def _flush_text(self) -> None:
+        if self.text:
+            if self.text_nodes is not None:
+                self.text_nodes.append(''.join(self.text))
+            self.text = []
+
+    def start(self, tag: str, attrib: Dict[str, str]) -> None:
+        self._flush_text()
+        node = _Node(tag, attrib)
+        parent = self.stack[-1] if self.stack else None
+
+        if len(self.stack) == 2 and parent.tag == 'body':
+            if tag == 'ul':
+                self.builder.add_list()
+            if tag == 'p' or get_heading_level(tag) is not None:
+                self.text_nodes = []
+
+        if parent is not None:
+            if tag == 'li' and parent.tag == 'ol' and 'mw-references' in parent.attrib.get('class', ''):
+                self.num_references += 1
+                node.reference_id = self.num_references
+            elif tag == 'span' and parent.reference_id is not None:
+                node.is_reference_text = attrib.get('class') == 'mw-reference-text'
+            elif tag == 'span' and parent.is_reference_text and 'data-mw' in attrib:
+                # Sometimes there may be more than one valid child (see Obama #136)
+                # For now, we take the first valid child as the reference.
+                reference_id = self.stack[-2].reference_id
+                if reference_id not in self.templates:
+                    self.templates[reference_id] = attrib['data-mw']
+
+        self.stack.append(node)
+
+    def end(self, tag: str) -> None:
+        self._flush_text()
+        node = self.stack.pop()
+        if len(self.stack) == 2 and self.stack[1].tag == 'body' and self.text_nodes is not None:
+            if node.tag == 'p':
+                self.builder.add_paragraph(*parse_text_nodes(self.text_nodes))
+            else:
+                self.builder.add_heading(''.join(self.text_nodes), get_heading_level(node.tag))
+            self.text_nodes = None
+
+    def data(self, data: str) -> None:
+        self.text.append(data)
+
+    def close(self) -> Tuple[Article, Dict[int, str]]:
+        return self.builder.finish(), self.templates
+
+
+def parse_page(title: str, page_id: int, html: str,
+               cited_only: bool = False) -> Tuple[Article, References]:
+    # Parses the article and its references in a single pass over the html.
+    # If `cited_only` is True, only the references which are cited in the
+    # article's paragraphs are decoded and kept.
+    parser = lxml.etree.HTMLParser(target=_PageTarget(title, page_id))
+    parser.feed(html)
+    article, templates = parser.close()
+
+    reference_ids = None
+    if cited_only:
+        reference_ids = set()
+        for paragraph in article.paragraphs():
+            reference_ids.update(paragraph.reference_ids())
+    references = parse_reference_templates(templates, reference_ids)
+    return article, references
@@ -2,65 +2,146 @@ import argparse
 import bz2file as bz2
 import json
 import logging
-import lxml.html
 import os
-import spacy
 import sys
-from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterator, List, Tuple, Union
 
-from wikicite.wikipedia.article import parse_article
-from wikicite.wikipedia.reference import parse_references
+from wikicite.pipeline import executor_map, prefetch
+from wikicite.wikipedia.article import segment_sentences
+from wikicite.wikipedia.columnar import ColumnarArticleWriter
+from wikicite.wikipedia.page_parser import parse_page
+from wikicite.wikipedia.sentences import load_segmenter, segmenter_backends
 
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
-nlp = spacy.load('en', disable=['ner'])
 
+# The sentence segmenter of this process. Every worker process loads its own
+# copy once instead of receiving it with every batch.
+_nlp = None
 
-def main(args):
-    shard_id = args.shard_id
 
+def load_nlp(segmenter: str, spacy_model: str) -> None:
+    global _nlp
+    _nlp = load_segmenter(segmenter, spacy_model)
+
+
+def read_batches(html_file: str, articles_per_batch: int) -> Iterator[Tuple[int, List[bytes]]]:
+    batch = []
+    with bz2.open(html_file, 'rb') as f:
+        for line in f:
+            batch.append(line)
+            if len(batch) == articles_per_batch:
+                yield len(batch), batch
+                batch = []
+    if batch:
+        yield len(batch), batch
+
+
+def parse_batch(lines: List[bytes], cited_only: bool, batch_size: int, n_process: int,
+                output_format: str) -> Union[bytes, List[Dict[str, Any]]]:
+    # Parses the articles, splits all of their sentences together and returns
+    # the output jsonl, or the output dicts for the columnar format
+    articles = []
+    for line in lines:
+        data = json.loads(line.decode())
+        title = data['title']
+        page_id = data['page_id']
+        html = data['html']
+
+        if html is None:
+            logging.warn(f'HTML for ({title}, {page_id}) is `None`')
+            continue
+
+        try:
+            article, references = parse_page(title, page_id, html, cited_only=cited_only)
+            if references is None or len(references.references) == 0:
+                logging.warn(f'References for ({title}, {page_id}) are empty')
+                continue
+
+            if article is None or article.is_empty():
+                logging.warn(f'Article for ({title}, {page_id}) is empty')
+                continue
+
+            articles.append((article, references))
+        except Exception as e:
+            logging.warn(f'Exception processing ({title}, {page_id}). Exception: {e}')
+
+    try:
+        segment_sentences(_nlp, [article for article, _ in articles], batch_size, n_process)
+    except Exception as e:
+        # Split each article on its own so that only the one which fails
+        # (e.g. because its text is longer than `nlp.max_length`) is skipped
+        logging.warn(f'Exception splitting the sentences of a batch, retrying each article. Exception: {e}')
+        segmented = []
+        for article, references in articles:
+            try:
+                segment_sentences(_nlp, [article], batch_size)
+                segmented.append((article, references))
+            except Exception as e:
+                logging.warn(f'Exception processing ({article.title}, {article.page_id}). Exception: {e}')
+        articles = segmented
+    output = []
+    for article, references in articles:
+        output_data = article.to_json()
+        output_data['references'] = references.to_json()
+        output.append(output_data)
+
+    if output_format == 'columnar':
+        return output
+    return b''.join(json.dumps(output_data).encode() + b'\n' for output_data in output)
+
+
+def open_output(shard_id: int, output_format: str):
     output_dir = 'data/wikipedia/articles'
-    output_file = os.path.join(output_dir, f'articles-{shard_id}.jsonl.bz2')
     os.makedirs(output_dir, exist_ok=True)
+    if output_format == 'columnar':
+        output_file = os.path.join(output_dir, f'articles-{shard_id}.npz')
+        return ColumnarArticleWriter(output_file)
+    output_file = os.path.join(output_dir, f'articles-{shard_id}.jsonl.bz2')
+    return bz2.open(output_file, 'wb')
+
+
+def main(args):
+    shard_id = args.shard_id
 
     html_file = f'data/wikipedia/html/html-{shard_id}.jsonl.bz2'
-    with bz2.open(html_file, 'rb') as f:
-        with bz2.open(output_file, 'wb') as out:
+    parse = partial(parse_batch, cited_only=args.cited_references_only,
+                    batch_size=args.batch_size, n_process=args.n_process, output_format=args.format)
+
+    # The batches of articles are read in a background thread and, with
+    # --num-workers, parsed by a pool of processes which each load spaCy
+    # once. The main thread compresses the output in the original order while
+    # the next batches are parsed.
+    executor = None
+    batches = prefetch(read_batches(html_file, args.articles_per_batch), args.num_workers * 2)
+    if args.num_workers > 1:
+        executor = ProcessPoolExecutor(args.num_workers, initializer=load_nlp,
+                                       initargs=(args.segmenter, args.spacy_model))
+        results = prefetch(executor_map(executor, parse, batches, args.num_workers * 2), args.num_workers * 2)
+    else:
+        load_nlp(args.segmenter, args.spacy_model)
+        results = ((num_lines, parse(lines)) for num_lines, lines in batches)
+
+    try:
+        with open_output(shard_id, args.format) as out:
             count = 0
             logging.info('Starting to parse')
-            for line in f:
-                data = json.loads(line.decode())
-                title = data['title']
-                page_id = data['page_id']
-                html = data['html']
-
-                if html is None:
-                    logging.warn(f'HTML for ({title}, {page_id}) is `None`')
-                    continue
-
-                try:
-                    tree = lxml.html.parse(StringIO(html))
-                    lxml.etree.strip_tags(tree, lxml.etree.Comment)
-
-                    references = parse_references(tree)
-                    if references is None or len(references.references) == 0:
-                        logging.warn(f'References for ({title}, {page_id}) are empty')
-                        continue
-
-                    article = parse_article(nlp, title, page_id, tree)
-                    if article is None or article.is_empty():
-                        logging.warn(f'Article for ({title}, {page_id}) is empty')
-                        continue
-
-                    output_data = article.to_json()
-                    output_data['references'] = references.to_json()
-                    out.write(json.dumps(output_data).encode() + b'\n')
-                except Exception as e:
-                    logging.warn(f'Exception processing ({title}, {page_id}). Exception: {e}')
-
-                count += 1
-                if count % 1000 == 0:
+            for num_lines, output in results:
+                if args.format == 'columnar':
+                    for output_data in output:
+                        out.write(output_data)
+                else:
+                    out.write(output)
+
+                previous_count = count
+                count += num_lines
+                if count // 1000 > previous_count // 1000:
                     logging.info(f'Processed {count} entries')
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     logging.info('Terminating')
 
@@ -68,5 +149,21 @@ def main(args):
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('shard_id', type=int)
+    argp.add_argument('--num-workers', type=int, default=1,
+                      help='The number of processes which parse the articles')
+    argp.add_argument('--format', choices=['jsonl', 'columnar'], default='jsonl',
+                      help='Write articles-<shard>.jsonl.bz2 or the columns in articles-<shard>.npz')
+    argp.add_argument('--cited-references-only', action='store_true',
+                      help='Only decode and output the references which are cited in the paragraphs. '
+                           'Articles without any cited references are then skipped.')
+    argp.add_argument('--segmenter', choices=segmenter_backends, default='parser',
+                      help='The spaCy component which splits the sentences')
+    argp.add_argument('--spacy-model', default='en')
+    argp.add_argument('--articles-per-batch', type=int, default=100,
+                      help='The number of articles whose sentences are split together')
+    argp.add_argument('--batch-size', type=int, default=256,
+                      help='The number of paragraphs spaCy processes at once')
+    argp.add_argument('--n-process', type=int, default=1,
+                      help='The number of processes spaCy splits the sentences with')
     args = argp.parse_args()
     main(args)
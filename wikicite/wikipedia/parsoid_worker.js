@@ -0,0 +1,28 @@
+// Renders wikitext to html with Parsoid for node_workers.py. Parsoid and its
+// configuration are only loaded once instead of for every article.
+'use strict';
+
+const path = require('path');
+const serve = require('../node_worker').serve;
+const Parsoid = require(path.resolve('ext/parsoid/lib/index.js'));
+
+// The same options as `bin/parse --offline true`
+const parsoidOptions = {
+  loadWMF: true,
+  fetchConfig: false,
+  fetchTemplates: false,
+  fetchImageInfo: false,
+  usePHPPreProcessor: false,
+  expandExtensions: false,
+};
+
+serve(function(wikitext) {
+  return Parsoid.parse({
+    input: wikitext,
+    mode: 'wt2html',
+    parsoidOptions: parsoidOptions,
+    envOptions: { domain: 'en.wikipedia.org', prefix: 'enwiki' },
+  }).then(function(res) {
+    return res.html;
+  });
+});
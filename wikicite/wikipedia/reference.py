@@ -1,6 +1,6 @@
 import json
 import dateutil.parser
-from typing import Dict
+from typing import Container, Dict
 
 
 class ReferenceError(Exception):
@@ -98,3 +98,17 @@ def parse_references(tree):
             pass
 
     return References(references)
+
+
+def parse_reference_templates(templates: Dict[int, str], reference_ids: Container[int] = None) -> References:
+    # Parses the raw `data-mw` json of each reference. If `reference_ids` is
+    # given, only those references are decoded.
+    references = {}
+    for id_, data_mw in templates.items():
+        if reference_ids is not None and id_ not in reference_ids:
+            continue
+        try:
+            references[id_] = Reference(id_, json.loads(data_mw))
+        except ReferenceError:
+            pass
+    return References(references)
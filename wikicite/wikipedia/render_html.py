@@ -3,28 +3,27 @@ import bz2file as bz2
 import json
 import logging
 import os
-import subprocess
 import sys
+from typing import Iterator, Tuple
+
+from wikicite.node_workers import NodeWorkerPool
 
 timeout = 60
+_parsoid_worker = os.path.join(os.path.dirname(__file__), 'parsoid_worker.js')
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
 
-def render(wikitext: str) -> str:
-    if not os.path.exists('ext/parsoid/bin/parse.js'):
-        raise Exception('Parsoid is not installed. Run "sh scripts/setup.sh"')
-
-    devnull = open(os.devnull, 'w')
-    process = subprocess.Popen('node ext/parsoid/bin/parse --offline true'.split(),
-                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                               stderr=devnull)
-    try:
-        stdout, _ = process.communicate(input=wikitext.encode(),
-                                        timeout=timeout)
-        return stdout.decode()
-    except subprocess.TimeoutExpired:
-        process.kill()
-        return None
+def load_wikitext(wikitext_file: str) -> Iterator[Tuple[Tuple[str, int], str]]:
+    with bz2.open(wikitext_file, 'rb') as f:
+        for line in f:
+            data = json.loads(line.decode())
+            title = data['title']
+            page_id = data['page_id']
+            wikitext = data['wikitext']
+            if wikitext is None:
+                logging.warn(f'Wikitext for ({title}, {page_id}) is `None`')
+                continue
+            yield (title, page_id), wikitext
 
 
 def main(args):
@@ -34,23 +33,18 @@ def main(args):
     output_file = os.path.join(output_dir, f'html-{shard_id}.jsonl.bz2')
     os.makedirs(output_dir, exist_ok=True)
 
+    if not os.path.exists('ext/parsoid/bin/parse.js'):
+        raise Exception('Parsoid is not installed. Run "sh scripts/setup.sh"')
+
     wikitext_file = os.path.join(f'data/wikipedia/wikitext/wikitext-{shard_id}.jsonl.bz2')
-    with bz2.open(wikitext_file, 'rb') as f:
+    with NodeWorkerPool(_parsoid_worker, args.num_workers, timeout,
+                        max_requests=args.max_requests, max_memory_mb=args.max_memory_mb) as pool:
         with bz2.open(output_file, 'wb') as out:
             count = 0
             logging.info('Starting to render')
-            for line in f:
-                data = json.loads(line.decode())
-                title = data['title']
-                page_id = data['page_id']
-                wikitext = data['wikitext']
-                if wikitext is None:
-                    logging.warn(f'Wikitext for ({title}, {page_id}) is `None`')
-                    continue
-
-                html = render(wikitext)
+            for (title, page_id), html in pool.map(load_wikitext(wikitext_file)):
                 if html is None:
-                    logging.warn(f'Rendering ({title}, {page_id}) timed out')
+                    logging.warn(f'Rendering ({title}, {page_id}) failed or timed out')
                     continue
 
                 output_data = {
@@ -70,5 +64,11 @@ def main(args):
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('shard_id', type=int)
+    argp.add_argument('--num-workers', type=int, default=1,
+                      help='The number of Parsoid processes to render with at once')
+    argp.add_argument('--max-requests', type=int, default=10000,
+                      help='The number of articles a Parsoid process renders before it is restarted')
+    argp.add_argument('--max-memory-mb', type=float, default=2048,
+                      help='Parsoid processes which use more memory than this are restarted')
     args = argp.parse_args()
     main(args)
@@ -0,0 +1,44 @@
+import spacy
+from typing import Iterable, Iterator, List
+
+# The components which are not needed to split sentences with each backend
+_parser_disabled = ['tagger', 'ner']
+_senter_excluded = ['parser', 'ner']
+
+segmenter_backends = ['parser', 'senter', 'sentencizer']
+
+
+def load_segmenter(backend: str = 'parser', model: str = 'en'):
+    # Loads a spaCy pipeline which only splits sentences. "parser" uses the
+    # dependency parser's sentence boundaries, which is what the articles
+    # were originally split with. The parser does not depend on the tagger,
+    # so the boundaries are the same without it. "senter" uses the model's
+    # smaller statistical sentence recognizer (spaCy 3 models only) and
+    # "sentencizer" uses punctuation rules without a model, which are faster
+    # but split some paragraphs differently.
+    if backend == 'parser':
+        return spacy.load(model, disable=_parser_disabled)
+    if backend == 'senter':
+        nlp = spacy.load(model, exclude=_senter_excluded)
+        nlp.enable_pipe('senter')
+        return nlp
+    if backend == 'sentencizer':
+        nlp = spacy.blank('en')
+        if spacy.__version__.startswith('2.'):
+            nlp.add_pipe(nlp.create_pipe('sentencizer'))
+        else:
+            nlp.add_pipe('sentencizer')
+        return nlp
+    raise ValueError(f'Unknown sentence segmenter backend: {backend}')
+
+
+def segment(nlp,
+            texts: Iterable[str],
+            batch_size: int = 256,
+            n_process: int = 1) -> Iterator[List[List[int]]]:
+    # Yields the [start, end] character offsets of the sentences in each text.
+    # The texts are run through `nlp.pipe` in batches instead of one at a
+    # time. The offsets are lists to be consistent with the json
+    # deserialization.
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        yield [[sent.start_char, sent.end_char] for sent in doc.sents]